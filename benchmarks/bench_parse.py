@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""
+Parse speed and memory benchmarks on synthetic export files.
+
+    python benchmarks/bench_parse.py [--repeat 5] [--save results.json]
+                                     [--compare baseline.json]
+
+Writes a set of synthetic VEP/ERG and mfERG exports to a temporary
+directory, then reports the best wall time, throughput (MB/s, files/s)
+and peak traced memory of load_file, read_export_file and
+read_mferg_export_file on each. Results can be saved and compared with
+a previous run to catch parse speed regressions, e.g. before upgrading.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from espion_tools import parse_espion_export
+from espion_tools.parse_vep_export import read_export_file
+from espion_tools.parse_mferg_export import read_mferg_export_file
+from espion_tools.synthetic import write_vep_export, write_mferg_export
+
+# name, writer, writer arguments
+CASES = [
+    ('erg_small_6.64.14', write_vep_export,
+     {'steps': 3, 'channels': 2, 'results': 2, 'trials': 3, 'samples': 250}),
+    ('erg_small_6.0.56', write_vep_export,
+     {'steps': 3, 'channels': 2, 'results': 2, 'trials': 3, 'samples': 250,
+      'version': '6.0.56', 'norms': True}),
+    ('erg_trials', write_vep_export,
+     {'steps': 6, 'channels': 2, 'results': 2, 'trials': 100, 'samples': 500}),
+    ('vep_long', write_vep_export,
+     {'steps': 2, 'channels': 1, 'results': 1, 'trials': 200, 'samples': 2000,
+      'test_method': 'VEP Test'}),
+    ('mferg_61_binocular', write_mferg_export,
+     {'hexagons': 61, 'binocular': True}),
+    ('mferg_103_monocular', write_mferg_export,
+     {'hexagons': 103, 'binocular': False}),
+    ('mferg_103_binocular', write_mferg_export,
+     {'hexagons': 103, 'binocular': True, 'samples': 240}),
+]
+
+
+def measure(func, fpath, repeat):
+    """
+    Returns the best wall time of repeat calls and the peak traced memory
+    """
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        func(fpath)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    func(fpath)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def run(repeat):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, writer, kwargs in CASES:
+            fpath = os.path.join(tmpdir, name + '.txt')
+            writer(fpath, seed=0, **kwargs)
+            size = os.path.getsize(fpath)
+            if writer is write_vep_export:
+                parser = ('read_export_file', read_export_file)
+            else:
+                parser = ('read_mferg_export_file', read_mferg_export_file)
+            for func_name, func in (('load_file', parse_espion_export.load_file),
+                                    parser):
+                elapsed, peak = measure(func, fpath, repeat)
+                results['{}:{}'.format(name, func_name)] = {
+                    'bytes': size,
+                    'seconds': elapsed,
+                    'mb_per_s': size / 2**20 / elapsed,
+                    'files_per_s': 1 / elapsed,
+                    'peak_mb': peak / 2**20}
+    return results
+
+
+def report(results, baseline=None, threshold=0.1):
+    """
+    Print the results, flagging anything more than threshold slower than
+    baseline. Returns the number of regressions.
+    """
+    regressions = 0
+    print('{:<42} {:>8} {:>9} {:>9} {:>9}'.format(
+        'case', 'MB', 'MB/s', 'files/s', 'peak MB'))
+    for key, result in results.items():
+        line = '{:<42} {:>8.2f} {:>9.1f} {:>9.1f} {:>9.1f}'.format(
+            key, result['bytes'] / 2**20, result['mb_per_s'],
+            result['files_per_s'], result['peak_mb'])
+        if baseline and key in baseline:
+            change = result['seconds'] / baseline[key]['seconds'] - 1
+            line += '  {:+.0%}'.format(change)
+            if change > threshold:
+                line += '  REGRESSION'
+                regressions += 1
+        print(line)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per case, the best time is reported')
+    parser.add_argument('--save', help='write results to this json file')
+    parser.add_argument('--compare', help='json file from a previous run')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='slowdown reported as a regression, default 0.1')
+    args = parser.parse_args()
+
+    results = run(args.repeat)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.threshold)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+asyncio interface for loading espion export files.
+
+File contents are read in the event loop's default thread pool so the
+loop is never blocked on disk, and the CPU bound parsing runs in a
+configurable executor. Pass a ProcessPoolExecutor to parse on several
+cores, by default the loop's thread pool is used.
+
+    async for fpath, data, error in iter_files_async(paths, executor=pool):
+        ...
+"""
+import asyncio
+from collections import deque
+import logging
+from . import parse_espion_export
+from .export_file import ExportFile
+
+logger = logging.getLogger(__name__)
+
+
+def _read_bytes(fpath):
+    with open(fpath, 'rb') as f:
+        return f.read()
+
+
+def _parse_bytes(fpath, data, options):
+    """
+    Parse the contents of a file, run in the executor
+    """
+    with ExportFile(fpath, data=data) as f:
+        return parse_espion_export.load_file(f, **options)
+
+
+async def load_file_async(fpath, executor=None, semaphore=None, **options):
+    """
+    Asynchronous version of parse_espion_export.load_file.
+    executor - concurrent.futures executor the parsing runs in,
+               defaults to the event loop's default executor
+    semaphore - optional asyncio.Semaphore held while the file is read
+                and parsed, to limit how many files are worked on at once
+    Other keyword arguments (steps, channels, include_trials) are passed
+    to load_file.
+    """
+    if semaphore is not None:
+        async with semaphore:
+            return await load_file_async(fpath, executor=executor, **options)
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, _read_bytes, fpath)
+    return await loop.run_in_executor(executor, _parse_bytes, fpath, data, options)
+
+
+async def iter_files_async(fpaths, executor=None, concurrency=4, ordered=False,
+                           **options):
+    """
+    Asynchronously load many files, yielding (fpath, result, error) tuples
+    in the same form as parse_espion_export.load_files.
+    executor - executor the parsing runs in, see load_file_async
+    concurrency - maximum number of files read or parsed at once
+    ordered - yield results in the order of fpaths rather than as each
+              file finishes
+    Reading of some files overlaps with the parsing of others, and only
+    a bounded number of files are scheduled at a time so fpaths can be a
+    long or lazy iterable.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def load(fpath):
+        try:
+            data = await load_file_async(fpath, executor=executor,
+                                         semaphore=semaphore, **options)
+            return (fpath, data, None)
+        except Exception as e:
+            return (fpath, None, e)
+
+    fpaths = iter(fpaths)
+
+    def schedule(count):
+        tasks = []
+        for fpath in fpaths:
+            tasks.append(asyncio.ensure_future(load(fpath)))
+            if len(tasks) == count:
+                break
+        return tasks
+
+    # keep some files queued behind the semaphore so the next reads are
+    # ready to start as soon as a slot frees up
+    max_pending = concurrency * 2
+    if ordered:
+        pending = deque(schedule(max_pending))
+    else:
+        pending = set(schedule(max_pending))
+    try:
+        while pending:
+            if ordered:
+                done = [pending.popleft()]
+                await done[0]
+                pending.extend(schedule(1))
+            else:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                pending.update(schedule(len(done)))
+            for task in done:
+                yield task.result()
+    finally:
+        for task in pending:
+            task.cancel()
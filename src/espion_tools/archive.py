@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+Save and load parsed espion exports in a self contained binary format.
+
+The output of read_export_file / read_mferg_export_file (or load_file)
+is written to an uncompressed .npz file:
+    meta.npy    - JSON describing the headers, markers, summary, stimuli
+                  and the Step / StepChannel / Result / Hexagon structure
+    values.npy  - every TimeSeries' values concatenated into one float array
+    offsets.npy - start of each series in values, plus the end of the last
+    starts.npy  - start time of each series
+    deltas.npy  - sample interval of each series
+Each TimeSeries read back is a view onto values, which can be memory
+mapped straight from the archive.
+"""
+from datetime import datetime
+import json
+import logging
+import struct
+import zipfile
+import numpy as np
+from . import espion_objects
+from .espion_objects import TimeSeries
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 2
+# version 1 archives only differ by having no 2-D series
+_READ_VERSIONS = (1, 2)
+
+_OBJECT_TYPES = ('Step', 'StepChannel', 'Result', 'Hexagon', 'Mferg')
+
+
+class _Encoder():
+    """
+    Converts parsed data to JSON compatible values, collecting the
+    time series separately.
+    """
+    def __init__(self):
+        self.series = []
+
+    def encode(self, obj):
+        if isinstance(obj, TimeSeries):
+            self.series.append(obj)
+            if obj.values.ndim > 1:
+                # stored flattened, e.g. the trials of a result
+                return {'__series__': len(self.series) - 1,
+                        'shape': list(obj.values.shape)}
+            return {'__series__': len(self.series) - 1}
+        if isinstance(obj, dict):
+            # keys are kept as pairs as JSON would turn int keys into strings
+            return {'__items__': [[self.encode(key), self.encode(value)]
+                                  for key, value in obj.items()]}
+        if isinstance(obj, list):
+            return [self.encode(value) for value in obj]
+        if isinstance(obj, tuple):
+            return {'__tuple__': [self.encode(value) for value in obj]}
+        if isinstance(obj, datetime):
+            return {'__datetime__': obj.isoformat()}
+        if isinstance(obj, np.ndarray) and obj.dtype.names:
+            # structured tables, e.g. markers read with tables=True
+            return {'__records__': {
+                'dtype': [list(field) for field in obj.dtype.descr],
+                'columns': {name: self.encode(obj[name].tolist())
+                            for name in obj.dtype.names}}}
+        if isinstance(obj, np.ndarray):
+            # small arrays of results, e.g. the EOG amplitudes
+            return {'__array__': {'dtype': obj.dtype.str,
+                                  'shape': list(obj.shape),
+                                  'values': obj.ravel().tolist()}}
+        if isinstance(obj, np.generic):
+            return obj.item()
+        name = type(obj).__name__
+        if name in _OBJECT_TYPES:
+            return {'__object__': name,
+                    'attrs': {key: self.encode(value)
+                              for key, value in _object_state(obj).items()}}
+        return obj
+
+
+def _object_state(obj):
+    if hasattr(obj, '__dict__'):
+        return vars(obj)
+    return {name: getattr(obj, name) for name in obj.__slots__}
+
+
+def _decode(obj, series):
+    if isinstance(obj, list):
+        return [_decode(value, series) for value in obj]
+    if not isinstance(obj, dict):
+        return obj
+    if '__series__' in obj:
+        if 'shape' in obj:
+            return series(obj['__series__'], obj['shape'])
+        return series(obj['__series__'])
+    if '__items__' in obj:
+        return {_decode(key, series): _decode(value, series)
+                for key, value in obj['__items__']}
+    if '__tuple__' in obj:
+        return tuple(_decode(value, series) for value in obj['__tuple__'])
+    if '__records__' in obj:
+        records = obj['__records__']
+        dtype = np.dtype([tuple(field) for field in records['dtype']])
+        columns = records['columns']
+        table = np.empty(len(next(iter(columns.values()), [])), dtype=dtype)
+        for name, values in columns.items():
+            table[name] = _decode(values, series)
+        return table
+    if '__array__' in obj:
+        array = obj['__array__']
+        return np.array(array['values'], dtype=array['dtype']).reshape(array['shape'])
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    if '__object__' in obj:
+        if obj['__object__'] not in _OBJECT_TYPES:
+            raise ValueError('Unknown object type:{}'.format(obj['__object__']))
+        cls = getattr(espion_objects, obj['__object__'])
+        instance = cls.__new__(cls)
+        for key, value in obj['attrs'].items():
+            setattr(instance, key, _decode(value, series))
+        return instance
+    return obj
+
+
+def save_npz(fpath, data, info=None):
+    """
+    Write parsed data to fpath.
+    data - dict returned by read_export_file or read_mferg_export_file
+    [info] - dict returned by find_type
+    """
+    encoder = _Encoder()
+    meta = {'version': FORMAT_VERSION,
+            'info': encoder.encode(info),
+            'data': encoder.encode(data)}
+    meta = np.frombuffer(json.dumps(meta).encode('utf-8'), dtype=np.uint8)
+
+    lengths = [series.values.size for series in encoder.series]
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    values = np.empty(offsets[-1], dtype=float)
+    for series, start, end in zip(encoder.series, offsets[:-1], offsets[1:]):
+        values[start:end] = series.values.ravel()
+    starts = np.array([series.start for series in encoder.series], dtype=float)
+    deltas = np.array([series.delta for series in encoder.series], dtype=float)
+
+    with open(fpath, 'wb') as f:
+        np.savez(f, meta=meta, values=values, offsets=offsets,
+                 starts=starts, deltas=deltas)
+
+
+def _memmap_member(fpath, archive, name):
+    """
+    Memory map an uncompressed .npy member of a zip archive
+    """
+    info = archive.getinfo(name)
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError('{} is compressed and cannot be memory mapped'.format(name))
+    with open(fpath, 'rb') as f:
+        # the local file header is 30 bytes followed by the name and extra field
+        f.seek(info.header_offset)
+        local_header = f.read(30)
+        name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+    if not shape or not shape[0]:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(fpath, dtype=dtype, mode='r', offset=offset, shape=shape,
+                     order='F' if fortran_order else 'C')
+
+
+def load_npz(fpath, mmap=False):
+    """
+    Read a file written by save_npz.
+    If mmap is True the time series values are memory mapped from the file
+    rather than read into memory.
+    Returns [info, data] in the same form as load_file.
+    """
+    with np.load(fpath) as archive:
+        meta = json.loads(archive['meta'].tobytes().decode('utf-8'))
+        if meta['version'] not in _READ_VERSIONS:
+            raise ValueError('Unsupported archive version:{}'.format(meta['version']))
+        offsets = archive['offsets']
+        starts = archive['starts']
+        deltas = archive['deltas']
+        if mmap:
+            with zipfile.ZipFile(fpath) as zf:
+                values = _memmap_member(fpath, zf, 'values.npy')
+        else:
+            values = archive['values']
+
+    def series(idx, shape=None):
+        series_values = values[offsets[idx]:offsets[idx + 1]]
+        if shape is not None:
+            series_values = series_values.reshape(shape)
+        return TimeSeries(float(starts[idx]), float(deltas[idx]), series_values)
+
+    return [_decode(meta['info'], series), _decode(meta['data'], series)]
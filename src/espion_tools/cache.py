@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+On disk cache of parsed espion export files
+"""
+import hashlib
+import logging
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+from . import parse_espion_export
+
+logger = logging.getLogger(__name__)
+
+# Increase whenever the structure returned by the parsers changes,
+# entries written with a different version are never read.
+CACHE_VERSION = 2
+
+_MAGIC = b'ESPC'
+_ALIGN = 64
+
+
+def _align(n):
+    return (n + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+class ParseCache():
+    """
+    Stores the result of parse_espion_export.load_file on disk so repeat
+    loads of an unchanged file skip the text parsing.
+
+    Entries are keyed by the file's path, size and modification time
+    (or its content hash if use_hash is True) plus the load options and
+    CACHE_VERSION. They are pickled with protocol 5 and the waveform
+    arrays are written out of band, so a warm load memory maps the entry
+    and the arrays are views onto it, copied only if they are modified.
+    On Windows the entry is read into memory once instead.
+    Once the cache grows beyond max_size bytes the least recently used
+    entries are removed.
+
+    >>> cache = ParseCache('/tmp/espion_cache')
+    >>> info, data = parse_espion_export.load_file(fname, cache=cache)
+    """
+    def __init__(self, cache_dir, max_size=2**30, use_hash=False):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.use_hash = use_hash
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, fpath, **options):
+        """
+        Returns the cache key for a file and set of load options
+        """
+        if self.use_hash:
+            digest = hashlib.sha256()
+            with open(fpath, 'rb') as f:
+                for chunk in iter(lambda: f.read(2**20), b''):
+                    digest.update(chunk)
+            source = digest.hexdigest()
+        else:
+            stat = os.stat(fpath)
+            source = (os.path.abspath(fpath), stat.st_size, stat.st_mtime_ns)
+        options = sorted((name, repr(value)) for name, value in options.items())
+        key = repr((CACHE_VERSION, source, options)).encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        """
+        Returns the cached value for key or None
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if os.name == 'posix' and size:
+                    # copy on write mapping, the arrays are backed by the
+                    # page cache and only copied if they are modified
+                    raw = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY)
+                else:
+                    # a mapped file could not be replaced or evicted on Windows
+                    raw = bytearray(size)
+                    f.readinto(raw)
+        except FileNotFoundError:
+            return None
+        try:
+            value = self._decode(raw)
+        except Exception as e:
+            logger.warning('Discarding unreadable cache entry:{} ({})'.format(path, e))
+            self._remove(path)
+            return None
+        # mark as recently used
+        os.utime(path)
+        return value
+
+    def put(self, key, value):
+        """
+        Writes value to the cache and evicts old entries if needed
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                self._encode(value, f)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            self._remove(tmp_path)
+            raise
+        self.evict()
+
+    def load_file(self, fpath, workers=None, **options):
+        """
+        Returns the cached result of load_file(fpath, **options),
+        parsing and storing it if needed.
+        workers is only used to parse a file that is not cached, it is
+        not part of the key.
+        """
+        key = self.key(fpath, **options)
+        value = self.get(key)
+        if value is None:
+            logger.debug('Cache miss:{}'.format(fpath))
+            value = parse_espion_export.load_file(fpath, workers=workers, **options)
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits in max_size
+        """
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.pkl'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        total = sum(size for mtime, size, path in entries)
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.debug('Evicting:{}'.format(path))
+            self._remove(path)
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(('.pkl', '.tmp')):
+                self._remove(entry.path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _encode(value, f):
+        """
+        Layout: magic, body length, buffer count, buffer lengths, body,
+        then each buffer aligned to 64 bytes.
+        """
+        buffers = []
+        body = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+        raws = [buffer.raw() for buffer in buffers]
+        header = _MAGIC + struct.pack('<QQ', len(body), len(raws))
+        header += struct.pack('<{}Q'.format(len(raws)), *[raw.nbytes for raw in raws])
+        f.write(header)
+        f.write(body)
+        pos = len(header) + len(body)
+        for raw in raws:
+            f.write(b'\0' * (_align(pos) - pos))
+            f.write(raw)
+            pos = _align(pos) + raw.nbytes
+
+    @staticmethod
+    def _decode(raw):
+        if raw[:4] != _MAGIC:
+            raise ValueError('Not a cache entry')
+        body_len, count = struct.unpack_from('<QQ', raw, 4)
+        pos = 20
+        lengths = struct.unpack_from('<{}Q'.format(count), raw, pos)
+        pos += 8 * count
+        view = memoryview(raw)
+        body = view[pos:pos + body_len]
+        pos += body_len
+        buffers = []
+        for length in lengths:
+            pos = _align(pos)
+            buffers.append(view[pos:pos + length])
+            pos += length
+        return pickle.loads(body, buffers=buffers)
@@ -1,4 +1,5 @@
 import logging
+import numpy as np
 
 logger = logging.getLogger(__name__)
 class FileError(Exception):
@@ -8,14 +9,133 @@ class FileError(Exception):
 
 
 class TimeSeries():
-    def __init__(self, start, delta, values=[]):
+    """
+    A regularly sampled series of values.
+    values are held in a float64 numpy array, the time of each sample is
+    not stored but generated from start and delta when needed.
+    values can be 2-D, e.g. the trials of a result, one series per row
+    sharing the same time axis. Each row is contiguous in memory.
+    """
+    __slots__ = ('start', 'delta', 'values')
+
+    def __init__(self, start, delta, values=None):
         self.start = start
         self.delta = delta
-        self.values = []
-        if values:
-            self.values = values
+        if values is None:
+            values = ()
+        values = np.asarray(values, dtype=float)
+        if values.ndim < 2 or values.strides[-1] != values.itemsize:
+            values = np.ascontiguousarray(values)
+        self.values = values
+
+    @property
+    def time(self):
+        """
+        The time of each sample
+        """
+        return self.start + self.delta * np.arange(self.values.shape[-1])
+
+    def as_numpy(self):
+        """
+        Returns the values array, not a copy. This is the way to hand the
+        values to other code without copying on every supported Python,
+        memoryview(series) needs Python 3.12.
+        """
+        return self.values
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        if self.values.ndim > 1:
+            return (TimeSeries(self.start, self.delta, row) for row in self.values)
+        return iter(self.values)
+
+    def __getitem__(self, key):
+        """
+        For a 1-D series an integer index returns a single value, a slice
+        returns a TimeSeries sharing this series' values.
+        For a 2-D series an integer index returns that row, and a slice
+        a 2-D TimeSeries of those rows, both sharing this series' values.
+        """
+        if self.values.ndim > 1:
+            return TimeSeries(self.start, self.delta, self.values[key])
+        if isinstance(key, slice):
+            first, _, step = key.indices(len(self.values))
+            return TimeSeries(self.start + first * self.delta,
+                              self.delta * step,
+                              self.values[key])
+        return self.values[key]
+
+    def __eq__(self, other):
+        if not isinstance(other, TimeSeries):
+            return NotImplemented
+        return (self.start == other.start and self.delta == other.delta
+                and self.values.shape == other.values.shape
+                and np.array_equal(self.values, other.values, equal_nan=True))
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # values is pickled by numpy, with protocol 5 and a buffer_callback
+        # it is passed out of band rather than copied into the pickle.
+        # numpy only does that for contiguous arrays, the rows of e.g.
+        # trials may be spaced apart in a larger block.
+        return (TimeSeries, (self.start, self.delta,
+                             np.ascontiguousarray(self.values)))
+
+    def __repr__(self):
+        return 'TimeSeries(start={}, delta={}, shape={})'.format(
+            self.start, self.delta, self.values.shape)
+
+    def __buffer__(self, flags):
+        # buffer protocol for Python objects (PEP 688), only used from
+        # Python 3.12, e.g. memoryview(series). Use as_numpy() on older
+        # versions.
+        return memoryview(self.values)
+
+
+class _Record():
+    """
+    Base for the slotted parse objects, compares and prints their slots
+    """
+    __slots__ = ()
+
+    def _state(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __eq__(self, other):
+        if type(other) is not type(self):
+            return NotImplemented
+        return self._state() == other._state()
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # slot values as a tuple, smaller and faster than a dict of names
+        return (_restore_record, (type(self), self._state()))
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(name, getattr(self, name)) for name in self.__slots__))
+
+
+def _restore_record(cls, state):
+    record = cls.__new__(cls)
+    for name, value in zip(cls.__slots__, state):
+        setattr(record, name, value)
+    return record
+
+
+class Result(_Record):
+    """
+    data - the averaged TimeSeries
+    trials - 2-D TimeSeries, one row per trial sharing the time axis of
+             data. Iterating or indexing it gives a TimeSeries per trial.
+             An empty list if trials were not read.
+    """
+    __slots__ = ('result_number', 'data', 'trials', 'column', 'trial_count')
 
-class Result():
     def __init__(self, result_number):
         self.result_number = result_number
         self.data = None
@@ -23,7 +143,9 @@ class Result():
         self.column = None
         self.trial_count = 0
 
-class StepChannel():
+class StepChannel(_Record):
+    __slots__ = ('channel_number', 'result_count', 'results')
+
     def __init__(self, channel_number):
         assert int(channel_number) > 0, 'Invalud channel number'
         self.channel_number = channel_number
@@ -34,7 +156,9 @@ class StepChannel():
         if result_number not in self.results.keys():
             self.results[result_number] = Result(result_number)
 
-class Step():
+class Step(_Record):
+    __slots__ = ('description', 'stim', 'step_number', 'channels', 'column')
+
     def __init__(self, step_number):
         assert int(step_number) > 0, 'Invalid step number'
         self.description = ''
@@ -47,11 +171,15 @@ class Step():
         if channel_id not in self.channels.keys():
             self.channels[channel_id] = StepChannel(channel_id)
 
-class Mferg():
+class Mferg(_Record):
+    __slots__ = ('hexagons',)
+
     def __init__(self):
         self.hexagons = []
 
-class Hexagon():
+class Hexagon(_Record):
+    __slots__ = ('hex_id', 'eye', 'n1', 'p1', 'data_raw', 'data_smooth')
+
     def __init__(self, eye, hex_id):
         self.hex_id = hex_id
         self.eye = eye
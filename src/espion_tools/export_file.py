@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+"""
+Row indexed access to an espion export file
+"""
+from concurrent.futures import Executor, ProcessPoolExecutor
+import contextlib
+import io
+import logging
+import mmap
+import os
+import numpy as np
+from .utils import as_float_block
+
+logger = logging.getLogger(__name__)
+
+# blocks smaller than this are never split between workers
+PARALLEL_MIN_BYTES = 2**22
+
+
+def open_export_file(source):
+    """
+    Returns an ExportFile for a path, or a context that leaves an already
+    open ExportFile open so it can be shared between parsers.
+    """
+    if isinstance(source, ExportFile):
+        return contextlib.nullcontext(source)
+    return ExportFile(source)
+
+
+def _fill_empty(block, sep):
+    """
+    Write nan into every empty field of a block of separated rows.
+    sep is a single byte.
+    """
+    raw = np.frombuffer(block, dtype=np.uint8)
+    sep = sep[0]
+    is_sep = raw == sep
+    # a field is empty if it starts at the beginning of the block or after
+    # a separator or newline and is immediately followed by another
+    # separator, line ending or the end of the block
+    after_boundary = np.ones(len(raw) + 1, dtype=bool)
+    after_boundary[1:] = is_sep | (raw == ord('\n'))
+    at_boundary = np.ones(len(raw) + 1, dtype=bool)
+    at_boundary[:-1] = is_sep | (raw == ord('\n')) | (raw == ord('\r'))
+    # a final line ending does not start another field
+    at_boundary[-1] = not block.endswith(b'\n')
+    empty = np.flatnonzero(after_boundary & at_boundary)
+    if not len(empty):
+        return block
+    nan = np.frombuffer(b'nan', dtype=np.uint8)
+    return np.insert(raw, np.repeat(empty, len(nan)),
+                     np.tile(nan, len(empty))).tobytes()
+
+
+def _tokenize(block, sep, usecols):
+    """
+    Convert a block of rows to floats, runs in a worker for parallel reads
+    """
+    block = _fill_empty(block, sep.encode('ascii'))
+    try:
+        return np.loadtxt(io.BytesIO(block), dtype=float, delimiter=sep,
+                          usecols=usecols, comments=None, ndmin=2)
+    except IndexError as e:
+        # raised by older numpy versions when a row is too short
+        raise ValueError(str(e))
+
+
+@contextlib.contextmanager
+def _executor(workers):
+    """
+    An executor for workers, an int number of processes or an Executor
+    which is left running
+    """
+    if isinstance(workers, Executor):
+        yield workers
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            yield executor
+
+
+class ExportFile():
+    """
+    An export file memory mapped with a row -> byte offset index.
+
+    The index is built in a single pass, extended only as far as the rows
+    that have been asked for, so the section parsers can jump straight to
+    the rows they need with seek_row rather than rewinding and re-reading
+    the file from the start, and reading just the first few rows does
+    not scan the rest of the file.
+    Supports enough of the text file interface (readline, seek(0)) to be
+    passed to the section parsers in place of an open file, and
+    read_float_block to tokenize numeric columns straight from the bytes.
+
+    Sections that have already been parsed can be kept in the sections
+    dict so later parses of the same file reuse them.
+
+    Rows are numbered from 1 to match the Contents Table.
+
+    rows_read, bytes_read and floats_read count what the parsers have
+    read, see profiling.
+    """
+    def __init__(self, filepath, encoding='utf-8', errors='ignore', use_mmap=True,
+                 data=None):
+        """
+        filepath - file to open
+        use_mmap - map the file rather than reading it into memory
+        data - contents of the file as bytes, if given filepath is only
+               used as a name and is not opened
+        """
+        self.filepath = filepath
+        self.encoding = encoding
+        self.errors = errors
+        # parsed sections, e.g. 'contents', 'headers'
+        self.sections = {}
+        self._mmap = None
+        if data is not None:
+            self._data = data
+        else:
+            with open(filepath, 'rb') as f:
+                if use_mmap:
+                    try:
+                        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    except ValueError:
+                        # empty files cannot be mapped
+                        pass
+                if self._mmap is not None:
+                    self._data = self._mmap
+                else:
+                    self._data = f.read()
+        # byte offset of the start of each indexed row, followed by the end
+        # of the last indexed row
+        self._offsets = [0]
+        self._indexed = False
+        self._row = 0
+        self.rows_read = 0
+        self.bytes_read = 0
+        self.floats_read = 0
+
+    @property
+    def contents(self):
+        """
+        Section bounding boxes from the Contents Table, if it has been parsed
+        """
+        return self.sections.get('contents')
+
+    def _index_to(self, row=None):
+        """
+        Extend the row index to cover row, or the whole file if row is None
+        """
+        if self._indexed:
+            return
+        offsets = self._offsets
+        find = self._data.find
+        pos = offsets[-1]
+        while row is None or len(offsets) <= row:
+            pos = find(b'\n', pos)
+            if pos < 0:
+                if offsets[-1] != len(self._data):
+                    offsets.append(len(self._data))
+                self._indexed = True
+                break
+            pos += 1
+            offsets.append(pos)
+
+    def has_row(self, row):
+        """
+        Returns True if the file has at least row rows
+        """
+        self._index_to(row)
+        return row < len(self._offsets)
+
+    def __repr__(self):
+        return 'ExportFile({!r})'.format(self.filepath)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        self._index_to()
+        return len(self._offsets) - 1
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+            self._data = b''
+
+    def row_offset(self, row):
+        """
+        Returns the byte offset of the start of row
+        """
+        self._index_to(row)
+        return self._offsets[row - 1]
+
+    def seek_row(self, row):
+        """
+        Move so the next call to readline returns row
+        """
+        self._row = max(row - 1, 0)
+
+    def seek(self, offset):
+        """
+        Only rewinding to the start of the file is supported
+        """
+        if offset != 0:
+            raise ValueError('ExportFile can only seek to 0, use seek_row')
+        self._row = 0
+
+    def readline(self):
+        """
+        Returns the next row as a string, '\r\n' line endings are
+        normalised to '\n'. Returns '' at the end of the file.
+        """
+        if not self.has_row(self._row + 1):
+            return ''
+        start = self._offsets[self._row]
+        end = self._offsets[self._row + 1]
+        self._row += 1
+        self.rows_read += 1
+        self.bytes_read += end - start
+        line = self._data[start:end].decode(self.encoding, self.errors)
+        if line.endswith('\r\n'):
+            line = line[:-2] + '\n'
+        return line
+
+    def _is_empty_row(self, row):
+        start = self._offsets[row - 1]
+        end = self._offsets[row]
+        return end - start <= 2 and self._data[start:end].strip() == b''
+
+    def read_float_block(self, first_row, columns, sep='\t', end_col=None,
+                         workers=None):
+        """
+        Reads the given columns (0 based) from first_row to the end of the
+        file, or the first empty row, tokenizing them straight from the
+        file's bytes without creating a string for every cell.
+        If end_col is given reading also stops at the first row with an
+        empty cell in that column.
+        Returns a 2-D float array with one row per requested column.
+        Empty cells are NaN.
+        Raises ValueError if the rows cannot be tokenized this way, for
+        example if some rows are shorter than others.
+        workers - split a large block into row ranges, using the row index,
+                  tokenized in parallel by this many processes, or by an
+                  Executor (e.g. a ProcessPoolExecutor kept for many files)
+        """
+        last_row = first_row
+        while self.has_row(last_row) and not self._is_empty_row(last_row):
+            last_row += 1
+        if last_row == first_row:
+            return np.empty((len(columns), 0))
+        usecols = list(columns)
+        if end_col is not None and end_col not in usecols:
+            usecols.append(end_col)
+        start = self._offsets[first_row - 1]
+        end = self._offsets[last_row - 1]
+        self.rows_read += last_row - first_row
+        self.bytes_read += end - start
+        if workers and end - start >= PARALLEL_MIN_BYTES:
+            if isinstance(workers, Executor):
+                chunks = os.cpu_count() or 1
+            else:
+                chunks = workers
+            chunks = min(chunks, last_row - first_row)
+            rows = np.linspace(first_row, last_row, chunks + 1).astype(int)
+            with _executor(workers) as executor:
+                futures = [executor.submit(_tokenize,
+                                           self._data[self._offsets[a - 1]:self._offsets[b - 1]],
+                                           sep, usecols)
+                           for a, b in zip(rows[:-1], rows[1:])]
+                values = np.concatenate([future.result() for future in futures])
+        else:
+            values = _tokenize(self._data[start:end], sep, usecols)
+        if end_col is not None:
+            empty = np.isnan(values[:, usecols.index(end_col)]).nonzero()[0]
+            if len(empty):
+                values = values[:empty[0]]
+        values = np.ascontiguousarray(values[:, :len(columns)].T)
+        self.floats_read += values.size
+        return values
+
+    def iter_float_blocks(self, first_row, columns, sep='\t', block_rows=256,
+                          end_col=None):
+        """
+        Reads the given columns (0 based) from first_row to the end of the
+        file, or the first empty row, block_rows rows at a time.
+        If end_col is given reading also stops at the first row with an
+        empty cell in that column.
+        Yields (row, values) where row is the index of the block's first
+        row counted from first_row, and values a 2-D float array with one
+        row per requested column as for read_float_block.
+        Rows are found by scanning forwards from first_row rather than by
+        extending the row index, so memory use depends on block_rows and
+        not on the length of the file.
+        """
+        if block_rows < 1:
+            raise ValueError('block_rows must be at least 1')
+        usecols = list(columns)
+        if end_col is not None and end_col not in usecols:
+            usecols.append(end_col)
+        data = self._data
+        size = len(data)
+        pos = self.row_offset(first_row) if self.has_row(first_row) else size
+        row = 0
+        while pos < size:
+            start = pos
+            count = 0
+            while count < block_rows and pos < size:
+                end = data.find(b'\n', pos)
+                end = size if end < 0 else end + 1
+                if end - pos <= 2 and data[pos:end].strip() == b'':
+                    # an empty row ends the block
+                    size = pos
+                    break
+                pos = end
+                count += 1
+            if not count:
+                break
+            self.rows_read += count
+            self.bytes_read += pos - start
+            try:
+                values = _tokenize(data[start:pos], sep, usecols)
+            except ValueError:
+                # e.g. short rows, convert this block a line at a time
+                lines = data[start:pos].decode(self.encoding, self.errors).splitlines()
+                cells = [line.split(sep) for line in lines]
+                values = as_float_block([[row[col] if col < len(row) else ''
+                                          for col in usecols] for row in cells],
+                                        len(usecols))
+            ended = False
+            if end_col is not None:
+                empty = np.isnan(values[:, usecols.index(end_col)]).nonzero()[0]
+                if len(empty):
+                    values = values[:empty[0]]
+                    ended = True
+            values = np.ascontiguousarray(values[:, :len(columns)].T)
+            self.floats_read += values.size
+            if values.shape[1]:
+                yield row, values
+            if ended:
+                break
+            row += count
+
+
+class LazyExport():
+    """
+    Base for parsed exports whose sections are only parsed when first
+    accessed. Holds the ExportFile open until close is called, parsed
+    sections are kept in its sections dict, keyed by name or, for sections
+    that depend on options, a tuple of name and options.
+    """
+    def __init__(self, filepath):
+        """
+        filepath - path or an open ExportFile, which is left open by close
+        """
+        self._context = open_export_file(filepath)
+        self.file = self._context.__enter__()
+
+    def __repr__(self):
+        return '{}({!r}, parsed={})'.format(type(self).__name__,
+                                             self.file.filepath,
+                                             sorted({name if isinstance(name, str) else name[0]
+                                                     for name in self.file.sections}))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._context is not None:
+            self._context.__exit__(None, None, None)
+            self._context = None
+
+    def _section(self, name, parse):
+        """
+        Returns the named section, calling parse() to read it the first time
+        """
+        sections = self.file.sections
+        if name not in sections:
+            if self._context is None:
+                raise ValueError('{} is closed'.format(self))
+            sections[name] = parse()
+        return sections[name]
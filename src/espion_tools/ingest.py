@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+Incremental ingest of a directory of export files.
+
+Each export is parsed into an .npz archive (see archive.save_npz) in an
+output directory, mirroring the layout of the source directory. A JSON
+manifest in the output directory records for every file its size,
+modification time, content hash, detected type and parse status, so a
+re-run only parses files that are new or have changed.
+
+    espion-ingest exports/ parsed/ --workers 8
+
+A file whose modification time changed but whose content hash did not
+(e.g. copied again) is not parsed again. Files that failed to parse are
+only retried once they change, or with --retry-failed.
+"""
+import argparse
+from datetime import datetime
+import glob
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from . import archive
+from .parse_espion_export import load_files
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+MANIFEST_NAME = 'manifest.json'
+
+
+def file_hash(fpath):
+    """
+    Returns the sha256 hex digest of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(fpath, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _write_atomic(fpath, write):
+    """
+    Calls write(tmp_path) then moves tmp_path to fpath, so fpath is never
+    left half written
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(fpath) or '.', suffix='.tmp')
+    os.close(fd)
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, fpath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class Manifest():
+    """
+    Record of the files ingested into an output directory, keyed by path
+    relative to the source directory.
+    """
+    def __init__(self, fpath):
+        self.fpath = fpath
+        self.files = {}
+        if os.path.exists(fpath):
+            with open(fpath, encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != MANIFEST_VERSION:
+                raise ValueError('Unsupported manifest version:{}'
+                                 .format(manifest.get('version')))
+            self.files = manifest['files']
+
+    def save(self):
+        def write(tmp_path):
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': MANIFEST_VERSION, 'files': self.files},
+                          f, indent=1, sort_keys=True)
+        _write_atomic(self.fpath, write)
+
+    def needs_parse(self, relpath, fpath, retry_failed=False):
+        """
+        Returns True if the file is new or has changed since it was last
+        ingested, updating its recorded modification time if only that
+        changed.
+        """
+        entry = self.files.get(relpath)
+        if entry is None:
+            return True
+        if entry['status'] != 'ok' and retry_failed:
+            return True
+        stat = os.stat(fpath)
+        if stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+            return False
+        if stat.st_size == entry['size'] and file_hash(fpath) == entry['sha256']:
+            entry['mtime_ns'] = stat.st_mtime_ns
+            return False
+        return True
+
+
+# exports are saved as .txt or .TXT
+DEFAULT_PATTERN = '**/*.[tT][xX][tT]'
+
+
+def ingest(source_dir, output_dir, pattern=DEFAULT_PATTERN, workers=None,
+           retry_failed=False, prune=False, save_every=100):
+    """
+    Parse the new and changed files matching pattern in source_dir into
+    output_dir.
+    workers - number of parsing processes, see load_files
+    retry_failed - parse files that previously failed even if unchanged
+    prune - remove the output and manifest entry of files that no longer
+            exist in source_dir
+    save_every - the manifest is saved after this many files are parsed,
+                 so an interrupted run keeps its progress
+    Returns a dict counting the files that were 'new', 'changed',
+    'unchanged', 'failed' and 'removed'.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = Manifest(os.path.join(output_dir, MANIFEST_NAME))
+    counts = {'new': 0, 'changed': 0, 'unchanged': 0, 'failed': 0, 'removed': 0}
+
+    fpaths = sorted(fpath for fpath in glob.glob(os.path.join(source_dir, pattern),
+                                                 recursive=True)
+                    if os.path.isfile(fpath))
+    relpaths = {fpath: os.path.relpath(fpath, source_dir) for fpath in fpaths}
+    pending = []
+    # size, modification time and hash taken before parsing, so a file
+    # that changes while it is parsed is parsed again on the next run
+    snapshots = {}
+    for fpath in fpaths:
+        relpath = relpaths[fpath]
+        if manifest.needs_parse(relpath, fpath, retry_failed):
+            stat = os.stat(fpath)
+            snapshots[fpath] = {'size': stat.st_size,
+                                'mtime_ns': stat.st_mtime_ns,
+                                'sha256': file_hash(fpath)}
+            pending.append(fpath)
+        else:
+            counts['unchanged'] += 1
+
+    parsed = 0
+    try:
+        for fpath, result, error in load_files(pending, workers=workers,
+                                               ordered=False):
+            relpath = relpaths[fpath]
+            previous = manifest.files.get(relpath)
+            counts['changed' if previous else 'new'] += 1
+            entry = dict(snapshots[fpath],
+                         parsed_at=datetime.now().isoformat(),
+                         info=None,
+                         status='ok',
+                         error=None,
+                         output=None)
+            if error is not None:
+                logger.warning('Failed to parse {}: {}'.format(fpath, error))
+                counts['failed'] += 1
+                entry['status'] = 'error'
+                entry['error'] = '{}: {}'.format(type(error).__name__, error)
+                if previous and previous['output']:
+                    # the archive of the earlier version no longer matches
+                    out_path = os.path.join(output_dir, previous['output'])
+                    if os.path.exists(out_path):
+                        os.remove(out_path)
+            else:
+                info, data = result
+                output = relpath + '.npz'
+                out_path = os.path.join(output_dir, output)
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                _write_atomic(out_path,
+                              lambda tmp_path: archive.save_npz(tmp_path, data, info))
+                entry['info'] = info
+                entry['output'] = output
+            manifest.files[relpath] = entry
+            parsed += 1
+            if parsed % save_every == 0:
+                manifest.save()
+
+        if prune:
+            present = set(relpaths.values())
+            for relpath in [relpath for relpath in manifest.files
+                            if relpath not in present]:
+                entry = manifest.files.pop(relpath)
+                if entry['output']:
+                    out_path = os.path.join(output_dir, entry['output'])
+                    if os.path.exists(out_path):
+                        os.remove(out_path)
+                counts['removed'] += 1
+    finally:
+        manifest.save()
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Parse new and changed Espion export files into .npz archives')
+    parser.add_argument('source', help='directory of export files')
+    parser.add_argument('output', help='directory for the archives and manifest')
+    parser.add_argument('--pattern', default=DEFAULT_PATTERN,
+                        help='glob of files to ingest, default .txt and .TXT files')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='parsing processes, default the cpu count')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='parse files that failed before even if unchanged')
+    parser.add_argument('--prune', action='store_true',
+                        help='remove archives of files no longer in source')
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    counts = ingest(args.source, args.output, pattern=args.pattern,
+                    workers=args.workers, retry_failed=args.retry_failed,
+                    prune=args.prune)
+    print(', '.join('{} {}'.format(count, name) for name, count in counts.items()))
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
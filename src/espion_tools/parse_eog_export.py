@@ -0,0 +1,137 @@
+"""
+Code to parse an espion EOG export file
+
+EOG exports use the VEP/ERG layout, each step is a recording made at a
+point in the dark or light adapted phase of the test, named in the step
+descriptions of the stimulus table (e.g. 'Dark 3', 'Light 10').
+The averaged sweep of every result is gathered into one 2-D array per
+channel so the saccade amplitudes, dark trough, light peak and Arden
+ratio are computed over all sweeps at once.
+"""
+
+import logging
+import numpy as np
+from .espion_objects import FileError, TimeSeries
+from .parse_vep_export import read_export_file
+
+logger = logging.getLogger(__name__)
+
+PHASES = ('dark', 'light')
+
+
+def step_phase(description):
+    """
+    Returns 'dark' or 'light' from a step description, '' if it is neither
+    """
+    description = description.lower()
+    for phase in PHASES:
+        if phase in description:
+            return phase
+    return ''
+
+def channel_sweeps(data, stimuli, channel):
+    """
+    Gathers the averaged sweep of every step and result of a channel.
+    data, stimuli - from read_export_file
+    Returns a dict
+        'steps', 'results' - step and result number of each sweep
+        'phases' - 'dark', 'light' or '' for each sweep
+        'sweeps' - 2-D TimeSeries, one row per sweep, padded with NaN
+                   where sweeps differ in length
+    """
+    keys = []
+    series = []
+    for step_id in sorted(data):
+        step_channel = data[step_id].channels.get(channel)
+        if step_channel is None:
+            continue
+        for result_id in sorted(step_channel.results):
+            result = step_channel.results[result_id]
+            if result.data is None:
+                continue
+            keys.append((step_id, result_id))
+            series.append(result.data)
+    if not series:
+        raise FileError('No sweeps found for channel:{}'.format(channel))
+    width = max(len(ts) for ts in series)
+    values = np.full((len(series), width), np.nan)
+    for row, ts in enumerate(series):
+        values[row, :len(ts)] = ts.values
+    steps = np.array([step_id for step_id, result_id in keys])
+    phases = np.array([step_phase(stimuli.get(step_id, {}).get('description', ''))
+                       for step_id in steps], dtype='U5')
+    return {'steps': steps,
+            'results': np.array([result_id for step_id, result_id in keys]),
+            'phases': phases,
+            'sweeps': TimeSeries(series[0].start, series[0].delta, values)}
+
+def saccade_amplitudes(sweeps, low=5, high=95):
+    """
+    Amplitude of the saccades in each sweep, taken as the spread between
+    the low and high percentiles of its samples so single spikes do not
+    dominate.
+    sweeps - 2-D TimeSeries or array, one row per sweep
+    """
+    values = sweeps.values if isinstance(sweeps, TimeSeries) else np.asarray(sweeps)
+    values = np.atleast_2d(values)
+    spread = np.nanpercentile(values, [low, high], axis=1)
+    return spread[1] - spread[0]
+
+def arden_ratio(amplitudes, phases, steps=None):
+    """
+    The smallest dark phase amplitude (dark trough), largest light phase
+    amplitude (light peak) and their ratio, the Arden ratio.
+    Returns a dict with keys dark_trough, light_peak, arden_ratio and,
+    if steps are given, dark_trough_step and light_peak_step.
+    Values are NaN (steps None) if a phase has no sweeps.
+    """
+    amplitudes = np.asarray(amplitudes, dtype=float)
+    phases = np.asarray(phases)
+    found = {}
+    for phase, name, pick in (('dark', 'dark_trough', np.nanargmin),
+                              ('light', 'light_peak', np.nanargmax)):
+        idx = np.flatnonzero((phases == phase) & ~np.isnan(amplitudes))
+        if len(idx):
+            best = idx[pick(amplitudes[idx])]
+            found[name] = float(amplitudes[best])
+            if steps is not None:
+                found[name + '_step'] = int(steps[best])
+        else:
+            found[name] = np.nan
+            if steps is not None:
+                found[name + '_step'] = None
+    if found['dark_trough']:
+        found['arden_ratio'] = found['light_peak'] / found['dark_trough']
+    else:
+        found['arden_ratio'] = np.nan
+    return found
+
+def analyse_eog(data, stimuli):
+    """
+    Sweeps, saccade amplitudes and Arden ratio of every channel.
+    Returns {channel: dict} combining channel_sweeps, 'amplitudes' and
+    arden_ratio.
+    """
+    channels = sorted({channel for step in data.values() for channel in step.channels})
+    eog = {}
+    for channel in channels:
+        sweeps = channel_sweeps(data, stimuli, channel)
+        sweeps['amplitudes'] = saccade_amplitudes(sweeps['sweeps'])
+        if not (sweeps['phases'] != '').any():
+            logger.warning('No dark or light steps found in the step descriptions')
+        sweeps.update(arden_ratio(sweeps['amplitudes'], sweeps['phases'],
+                                  sweeps['steps']))
+        eog[channel] = sweeps
+    return eog
+
+def read_eog_export_file(filepath, sep='\t', **options):
+    """
+    Parse an EOG export file.
+    Returns the dict from read_export_file, options are passed to it,
+    with an extra 'eog' key holding analyse_eog of the data.
+    Trials are not needed for the analysis, pass include_trials=False
+    to skip reading them.
+    """
+    export = read_export_file(filepath, sep=sep, **options)
+    export['eog'] = analyse_eog(export['data'], export['stimuli'])
+    return export
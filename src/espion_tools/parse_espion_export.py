@@ -3,10 +3,19 @@
 Code to parse an espion export file
 """
 from .exceptions import EspionExportError
-from .parse_vep_export import read_export_file
-from .parse_mferg_export import read_mferg_export_file
+from .export_file import open_export_file
+from .parse_vep_export import (EspionExport, read_export_file,
+                               read_contents_and_header)
+from .parse_eog_export import read_eog_export_file
+from .parse_mferg_export import (MfergExport, read_mferg_export_file,
+                                 read_parameters)
+from .profiling import stage_timer
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from itertools import islice
+import glob
 import logging
-import codecs
+import os
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +23,7 @@ def find_type(fpath):
     """
     Reads an espion export file and determines if it is an mfERG or VEP/ERG
     export format.
+    fpath can be a path or an open ExportFile.
     Returns a dict {'type': 'vep'|'mferg',
                     'test': 'erg'|'mferg'|'vep',
                     'sep': '\t'|','|' '|';'|':'}
@@ -24,8 +34,8 @@ def find_type(fpath):
                   'colon': ':'}
     export_type, sep = None, None
     
-    #with open(fpath, 'r') as f:
-    with codecs.open(fpath, 'r', encoding='utf-8', errors='ignore') as f:
+    with open_export_file(fpath) as f:
+        f.seek(0)
         line = f.readline()
         for key in separators:
             if separators[key] in line:
@@ -46,6 +56,8 @@ def find_type(fpath):
         else:
             while True:
                 line = f.readline()
+                if not line:
+                    raise EspionExportError('Test method not found')
                 line = line.split(sep)
                 line = [value.strip() for value in line]
                 if 'Test method' in  line:
@@ -66,20 +78,206 @@ def find_type(fpath):
             'test_type': test_type,
             'sep': sep})
         
-def load_file(fpath):
+def load_file(fpath, steps=None, channels=None, include_trials=True, cache=None,
+              tables=False, stats=None, on_stage=None, workers=None):
     """
     Parses an espion export file
     returns ['type': 'mferg'|'vep',
              'data': file contents]
+    EOG exports are read with read_eog_export_file, adding the 'eog'
+    analysis to the data.
     or raises an EspionExportError
+    steps, channels and include_trials limit which parts of a VEP/ERG
+    data table are read, they have no effect on mfERG files.
+    tables - return VEP/ERG markers and summary as structured arrays,
+             see parse_vep_export.parse_marker_array
+    cache - optional cache.ParseCache, an unchanged file that has been
+            loaded before is read from the cache instead of being parsed.
+    stats, on_stage - per stage profiling of the parse, see profiling.
+                      Files read from the cache are not profiled.
+    workers - number of processes, or an Executor, used to tokenize the
+              data table of a large file in parallel, see
+              ExportFile.read_float_block
+    """
+    if cache is not None:
+        return cache.load_file(fpath, steps=steps, channels=channels,
+                               include_trials=include_trials, tables=tables,
+                               workers=workers)
+    # the file is opened once and shared between detection and parsing
+    with open_export_file(fpath) as f:
+        with stage_timer(f, stats, on_stage)('find_type'):
+            info = find_type(f)
+        try:
+            if info['type'] == 'mferg':
+                data = read_mferg_export_file(f, sep=info['sep'], stats=stats,
+                                              on_stage=on_stage, workers=workers)
+            elif info['test_type'] == 'eog':
+                data = read_eog_export_file(f, sep=info['sep'], steps=steps,
+                                            channels=channels,
+                                            include_trials=include_trials,
+                                            tables=tables, stats=stats,
+                                            on_stage=on_stage, workers=workers)
+            else:
+                data = read_export_file(f, sep=info['sep'], steps=steps,
+                                        channels=channels,
+                                        include_trials=include_trials,
+                                        tables=tables, stats=stats,
+                                        on_stage=on_stage, workers=workers)
+        except Exception as e:
+            raise EspionExportError('Invalid file format:{} ({}: {})'
+                                    .format(fpath, type(e).__name__, e)) from e
+    return([info, data])
+
+def peek_metadata(fpath):
+    """
+    Reads the type and header information of an export file without
+    reading its data, only the first rows of the file are touched.
+    fpath can be a path or an open ExportFile, passing the same ExportFile
+    on to load_file reuses the parsed header.
+    Returns the find_type dict with the additional keys
+        'headers': VEP/ERG header table or mfERG parameters
+        'steps', 'channels': counts from the header table (VEP/ERG only)
+        'hexagons': number of hexagons (mfERG only)
+    or raises an EspionExportError
+    """
+    with open_export_file(fpath) as f:
+        info = find_type(f)
+        try:
+            if info['type'] == 'mferg':
+                headers = read_parameters(f, info['sep'])
+                info.update({'headers': headers,
+                             'steps': None,
+                             'channels': None,
+                             'hexagons': headers.get('Hexagons')})
+            else:
+                contents, headers = read_contents_and_header(f, info['sep'])
+                info.update({'headers': headers,
+                             'steps': headers.get('Steps'),
+                             'channels': headers.get('Channels'),
+                             'hexagons': None})
+        except Exception as e:
+            raise EspionExportError('Invalid file format:{} ({}: {})'
+                                    .format(fpath, type(e).__name__, e)) from e
+    return info
+
+def open_export(fpath, **options):
+    """
+    Opens an export file without parsing it.
+    Returns an EspionExport or MfergExport whose sections are parsed as
+    they are accessed, options are passed to the EspionExport.
+    Close it, or use it as a context manager, once finished with.
+    Raises an EspionExportError if the type of file is not recognised.
     """
     info = find_type(fpath)
     try:
         if info['type'] == 'mferg':
-            data = read_mferg_export_file(fpath, sep=info['sep'])
+            export = MfergExport(fpath, sep=info['sep'])
         else:
-            data = read_export_file(fpath, sep=info['sep'])
-    except:
-        raise EspionExportError('Invalid file format:{}'.format(fpath))
-    return([info, data])
-    
+            export = EspionExport(fpath, sep=info['sep'], **options)
+    except Exception as e:
+        raise EspionExportError('Invalid file format:{} ({}: {})'
+                                .format(fpath, type(e).__name__, e)) from e
+    export.info = info
+    return export
+
+def _load_file_captured(fpath):
+    """
+    Calls load_file in a worker process, returning any exception
+    rather than raising it so one bad file does not stop a batch.
+    """
+    try:
+        return (fpath, load_file(fpath), None)
+    except Exception as e:
+        return (fpath, None, e)
+
+def _load_file_shared(fpath):
+    """
+    As _load_file_captured, but returns the result as a
+    shared.SharedExport so only a small descriptor is pickled back
+    """
+    # imported here so load_file does not depend on multiprocessing.shared_memory
+    from .shared import share
+    fpath, result, error = _load_file_captured(fpath)
+    if result is not None:
+        result = share(result)
+    return (fpath, result, error)
+
+def _receive(future, shared):
+    fpath, result, error = future.result()
+    if shared and result is not None:
+        result = result.load()
+    return (fpath, result, error)
+
+def load_files(fpaths, workers=None, ordered=True, max_pending=None,
+               shared=False):
+    """
+    Parses espion export files in parallel using a pool of worker processes.
+    fpaths - iterable of file paths
+    workers - number of processes, defaults to the cpu count
+    ordered - if True results are yielded in the order of fpaths,
+              otherwise as soon as each file has been parsed
+    max_pending - maximum number of files submitted to the pool at once,
+                  defaults to twice the number of workers. Keeps memory
+                  bounded when fpaths is long.
+    shared - workers return the waveforms through shared memory rather
+             than pickling them, see shared.share. Faster for large files.
+    Yields (fpath, result, error) tuples, result is the return value of
+    load_file or None if the file failed, in which case error is the
+    exception that was raised.
+    When using the default process start method on Windows or macOS this must
+    be called from behind an if __name__ == '__main__' guard.
+    """
+    if not workers:
+        workers = os.cpu_count() or 1
+    if not max_pending:
+        max_pending = workers * 2
+    fpaths = iter(fpaths)
+    worker = _load_file_shared if shared else _load_file_captured
+    # futures still running, or finished but not yet yielded, when the
+    # caller stops, their shared memory is released once the pool closes
+    abandoned = []
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            def submit(count):
+                return [executor.submit(worker, fpath)
+                        for fpath in islice(fpaths, count)]
+
+            if ordered:
+                pending = deque(submit(max_pending))
+            else:
+                pending = set(submit(max_pending))
+            done = deque()
+            try:
+                while pending:
+                    if ordered:
+                        done.append(pending.popleft())
+                        pending.extend(submit(1))
+                    else:
+                        finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        done.extend(finished)
+                        pending.update(submit(len(finished)))
+                    while done:
+                        yield _receive(done.popleft(), shared)
+            finally:
+                abandoned.extend(done)
+                for future in pending:
+                    if not future.cancel():
+                        abandoned.append(future)
+    finally:
+        if shared:
+            for future in abandoned:
+                fpath, result, error = future.result()
+                if result is not None:
+                    result.unlink()
+
+def load_directory(pattern, workers=None, ordered=True, max_pending=None,
+                   shared=False):
+    """
+    Parses all files matching the glob pattern, e.g. 'exports/**/*.txt',
+    see load_files for the arguments and results.
+    """
+    fpaths = sorted(glob.glob(pattern, recursive=True))
+    fpaths = [fpath for fpath in fpaths if os.path.isfile(fpath)]
+    return load_files(fpaths, workers=workers, ordered=ordered,
+                      max_pending=max_pending, shared=shared)
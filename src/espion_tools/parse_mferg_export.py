@@ -5,18 +5,13 @@ from datetime import datetime
 import logging
 import re
 from .espion_objects import TimeSeries, FileError, Hexagon
-from .utils import as_int, as_float, read_split_line, find_section_col
+from .export_file import LazyExport, open_export_file
+from .profiling import stage_timer
+from .utils import (as_int, as_float, move_top, read_split_line,
+                    read_float_columns)
 
 logger = logging.getLogger(__name__)
 
-def move_top(f, lines):
-    """
-    Takes an open file and moves to the start of lines
-    """
-    f.seek(0)
-    for i in range(lines - 1):
-        f.readline()
-
 def parse_parameters(f, sep):
     logger.debug('Parsing parameters')
     parameters = {}
@@ -35,16 +30,65 @@ def parse_parameters(f, sep):
 
     return parameters
 
+EYE_LABELS = {'os': 'Left Eye (nV)',
+              'od': 'Right Eye (nV)'}
+
+def index_columns(f, sep):
+    """
+    Index the labels in the first two rows of an mfERG export in one pass
+    so sections and hexagon columns are found with a dictionary lookup
+    instead of scanning the row each time.
+    Returns {'rows': the first two rows split into values,
+             'sections': {label: [columns]} for the first row,
+             'eyes': {eye: column where that eye's time series start},
+             'eye_columns': {eye: {label: column}} for the second row
+                            within each eye's time series,
+             'time': column of 'Time (ms)'}
+    """
+    move_top(f, 1)
+    rows = [f.readline().rstrip('\r\n').split(sep) for i in range(2)]
+    sections = {}
+    for col, label in enumerate(rows[0]):
+        if label:
+            sections.setdefault(label, []).append(col)
+
+    eyes = {eye: sections[label][0] for eye, label in EYE_LABELS.items()
+            if label in sections}
+    eye_columns = {}
+    bounds = sorted(eyes.values()) + [len(rows[1])]
+    for eye, first in eyes.items():
+        last = bounds[bounds.index(first) + 1]
+        eye_columns[eye] = {}
+        for col in range(first, last):
+            eye_columns[eye].setdefault(rows[1][col], col)
+
+    time_col = None
+    if 'Time (ms)' in rows[1]:
+        time_col = rows[1].index('Time (ms)')
+    return {'rows': rows,
+            'sections': sections,
+            'eyes': eyes,
+            'eye_columns': eye_columns,
+            'time': time_col}
+
+def column_index(f, sep):
+    """
+    Returns the column index of an open file, building it only once
+    for an ExportFile.
+    """
+    sections = getattr(f, 'sections', {})
+    if 'columns' not in sections:
+        sections['columns'] = index_columns(f, sep)
+    return sections['columns']
+
 def parse_markers(f, sep):
     logger.debug('Parsing markers')
     hexagons = {}
 
-    move_top(f, 1)
-    line = read_split_line(f, split=sep)
-    move_top(f, 1)
-    start_col = find_section_col(line, 'Hexagon')
-    line = read_split_line(f, split=sep, start_col=start_col)
-    if line[5] == 'Left Eye':
+    index = column_index(f, sep)
+    start_col = index['sections']['Hexagon'][0]
+    line = index['rows'][0][start_col:]
+    if len(line) > 5 and line[5] == 'Left Eye':
         # both eyes exported
         binocular = True
     else:
@@ -53,8 +97,8 @@ def parse_markers(f, sep):
         eye = 'os'
     else:
         eye = 'od'
-        
-    f.readline()
+
+    move_top(f, 3)
     while True:
         line = read_split_line(f, split=sep, start_col=start_col)
         if line[0] == '':
@@ -64,7 +108,7 @@ def parse_markers(f, sep):
         hexagon1.p1 = (line[3], line[4])
 
         if binocular:
-            hexagon2 = Hexagon('os', line[1])
+            hexagon2 = Hexagon('os', line[0])
             hexagon2.n1 = (line[5], line[6])
             hexagon2.p1 = (line[7], line[8])
             hexagons[line[0]] = (hexagon1, hexagon2)
@@ -78,10 +122,9 @@ def parse_markers(f, sep):
 def parse_dimensions(f, sep):
     logger.debug('Parsing dimensions')
     dimensions = {}
-    move_top(f,1)
-    line = read_split_line(f, split=sep)
-    start_col = find_section_col(line, 'Dimensions')
+    start_col = column_index(f, sep)['sections']['Dimensions'][0]
 
+    move_top(f, 2)
     while True:
         line = read_split_line(f, split=sep, start_col=start_col)
         if line[0] == '':
@@ -92,9 +135,16 @@ def parse_dimensions(f, sep):
 def parse_positions(f, sep):
     logger.debug('Parsing positions')
     locations = {}
-    move_top(f,1)
-    line = read_split_line(f, split=sep)
-    start_col = find_section_col(line, ['Hexagon', 'X'])
+    index = column_index(f, sep)
+    # the positions section is the 'Hexagon' column followed by 'X'
+    x_cols = index['sections'].get('X', [])
+    start_col = None
+    for col in index['sections'].get('Hexagon', []):
+        if col + 1 in x_cols:
+            start_col = col
+            break
+
+    move_top(f, 2)
     while True:
         line = read_split_line(f, split=sep, start_col=start_col)
         if not line or line[0] == '':
@@ -112,82 +162,107 @@ def parse_positions(f, sep):
     logger.debug('Parsed positions')
     return locations
 
-def parse_timeseries(f, hexcount, sep, markers=None):
+def iter_timeseries(f, hexcount, sep, eyes=None, hex_ids=None, kinds=None,
+                    workers=None, block_rows=None):
+    """
+    Generator over the time series data,
+    f - file handle
+    hexcount - number of hexagons
+    sep - file seperator
+    [eyes] - eyes to return, any of 'od', 'os', defaults to all exported
+    [hex_ids] - hexagon numbers to return, defaults to all
+    [kinds] - any of 'raw', 'smooth', defaults to both
+    [workers] - number of processes, or an Executor, tokenizing a large
+                block in parallel row ranges, see ExportFile.read_float_block
+    [block_rows] - stream the series block_rows samples at a time
+
+    yields (eye, hex_id, kind, TimeSeries) for each requested series,
+    ordered by eye, hexagon then kind.
+    Only the columns of the requested series are converted to floats,
+    and they are all gathered from each row in a single pass.
+    Without block_rows this pass reads every requested series before the
+    first is yielded, so stopping early saves nothing; it is a filtered
+    rather than a lazy reader.
+    With block_rows each TimeSeries holds the next block_rows samples of
+    its series, starting at their time, and every requested series is
+    yielded for one block before the next block is read. Memory use then
+    depends on block_rows, and stopping early skips the rest of the file.
+    workers has no effect when streaming.
+    """
+    logger.debug('Parsing timeseries')
+    col_heads = {'raw': 'Hex {} (R)',
+                 'smooth': 'Hex {} (S)'}
+
+    if hex_ids is None:
+        hex_ids = range(1, hexcount + 1)
+    if kinds is None:
+        kinds = ('raw', 'smooth')
+
+    index = column_index(f, sep)
+    eye_columns = {eye: col for eye, col in index['eyes'].items()
+                   if eyes is None or eye in eyes}
+    time_col = index['time']
+    series = []
+    for eye, val in sorted(eye_columns.items(), key=lambda item: item[1]):
+        labels = index['eye_columns'][eye]
+        for hex_id in hex_ids:
+            for kind in kinds:
+                col = labels.get(col_heads[kind].format(hex_id))
+                if col is None:
+                    raise FileError('Column {} not found for eye {}'
+                                    .format(col_heads[kind].format(hex_id), eye))
+                series.append((eye, hex_id, kind, col))
+
+    columns = sorted(set([time_col] + [col for eye, hex_id, kind, col in series]))
+    block_row = {col: idx for idx, col in enumerate(columns)}
+    if block_rows is None:
+        block = read_float_columns(f, 3, columns, sep, end_col=time_col,
+                                   workers=workers)
+        time = block[block_row[time_col]]
+        time_1 = float(time[0])
+        delta = float(time[1]) - time_1
+        logger.debug('Got time info')
+
+        for eye, hex_id, kind, col in series:
+            yield (eye, hex_id, kind,
+                   TimeSeries(start=time_1, delta=delta, values=block[block_row[col]]))
+    else:
+        # timing from the first two rows so it does not depend on block_rows
+        for _, time in f.iter_float_blocks(3, [time_col], sep, 2, end_col=time_col):
+            time_1 = float(time[0][0])
+            delta = float(time[0][1]) - time_1
+            break
+        logger.debug('Got time info')
+
+        for first, block in f.iter_float_blocks(3, columns, sep, block_rows,
+                                                end_col=time_col):
+            for eye, hex_id, kind, col in series:
+                yield (eye, hex_id, kind,
+                       TimeSeries(start=time_1 + first * delta, delta=delta,
+                                  values=block[block_row[col]]))
+    logger.debug('Parsed timeseries')
+
+def parse_timeseries(f, hexcount, sep, markers=None, workers=None):
     """
     Parse time series data, 
     f - file handle
     hexcount - number of hexagons
     sep - file seperator
     [markers] - dict containing hexagon objects
+    [workers] - see iter_timeseries
     
     if markers is supplies adds data to existing object otherwise creates
     a new list (not yet implemented)
+    returns {eye: {'raw': {hex_id: TimeSeries}, 'smooth': {hex_id: TimeSeries}}}
     """
-    logger.debug('Parsing timeseries')
     if not markers:
         markers = {}
-    col_head_raw = 'Hex {} (R)'
-    col_head_smooth = 'Hex {} (S)'
-
-    eye_strs = {'os': {'str':'Left Eye (nV)'},
-                'od': {'str':'Right Eye (nV)'}}
-    eye_columns = {}
-
-    move_top(f,1)
-    line = read_split_line(f, split=sep)
-
-    for key, val in eye_strs.items():
-        eye_idx = find_section_col(line, val['str'])
-        if eye_idx:
-            eye_columns[key] = eye_idx
-
-    logger.debug('Getting time info')        
-    line = read_split_line(f, split=sep)
-    time_col = find_section_col(line, 'Time (ms)')
-    line = read_split_line(f, split=sep)
-    time_1 = as_float(line[time_col])
-    line = read_split_line(f, split=sep)
-    time_2 = as_float(line[time_col])
-    delta = time_2 - time_1
-    move_top(f, 2)
-    logger.debug('Got time info')
-    # find the column indexes for the raw and smooth data
-    # going to populate each item (hexagon) in the dict with the column index
-    # and a time series object
-    line = read_split_line(f, split=sep)
-    col_idx_raw = {}
-    col_idx_smooth = {}
-
-    for eye, val in eye_columns.items():
-        col_idx_raw[eye] = {}
-        col_idx_smooth[eye] = {}
-        for hex_id in range(hexcount):
-            hex_id = hex_id + 1
-            col_idx_raw[eye][hex_id] = [find_section_col(line, col_head_raw.format(hex_id), val), 
-                                       TimeSeries(start=time_1, delta=delta)]
-
-            col_idx_smooth[eye][hex_id] = [find_section_col(line, col_head_smooth.format(hex_id), val),
-                                          TimeSeries(start=time_1, delta=delta)]
-
-    while True:
-        line = read_split_line(f, split=sep)
-        if line[time_col] == '':
-            break
-        for hex_id in range(hexcount):
-            hex_id = hex_id + 1
-            for eye in eye_columns.keys():
-                # use the column index to read the data and populate the time series
-                if col_idx_raw[eye][hex_id]:
-                    col_idx_raw[eye][hex_id][1].values.append(float(line[col_idx_raw[eye][hex_id][0]]))
-                if col_idx_smooth[eye][hex_id]:
-                    col_idx_smooth[eye][hex_id][1].values.append(float(line[col_idx_smooth[eye][hex_id][0]]))
-    data={}
-    for eye in ('os','od'):
-        if eye in eye_columns.keys():
-            data[eye]= {}
-            data[eye]['raw'] = {key: val[1] for key, val in col_idx_raw[eye].items()}
-            data[eye]['smooth'] = {key: val[1] for key, val in col_idx_smooth[eye].items()}
-    logger.debug('Parsed timeseries')
+    data = {}
+    for eye, hex_id, kind, series in iter_timeseries(f, hexcount, sep,
+                                                     workers=workers):
+        if eye not in data:
+            data[eye] = {'raw': {}, 'smooth': {}}
+        data[eye][kind][hex_id] = series
     return(data)
 
 def parse_smooth_string(str):
@@ -217,45 +292,85 @@ def extract_number(str):
     return(m.group(1))
 
 
-def read_mferg_export_file(filepath, sep='\t'):
-    with open(filepath, 'r') as f:
+def parse_protocol(parameters):
+    """
+    Returns the stimulus protocol described by the parameters, in a
+    similar form to the ERG and VEP stimuli. Also sets
+    parameters['Protocol'].
+    """
+    smooth_details = parse_smooth_string(parameters['Smoothing'])
+    filter_details = parse_filter_string(parameters['Filtering'])
+    lum_on_details = parse_luminance_string(parameters['Luminance On'])
+    lum_off_details = parse_luminance_string(parameters['Luminance Off'])
+    # do this to make these files similar format to ERG and VEP
+    protocol = {'hex_count': parameters['Hexagons'],
+                'scaled': parameters['Scaled'],
+                'distortion': parameters['Distortion'],
+                'filter': parameters['Filter'],
+                'base_period': extract_number(parameters['Base Period']),
+                'correlated': extract_number(parameters['Correlated']),
+                'sequence_len': parameters['Sequence Bits'],
+                'smoothing_type': smooth_details[0].lower(),
+                'smoothing_level': smooth_details[1],
+                'filter_type': filter_details[0].lower(),
+                'filter_level': filter_details[1],
+                'filler_frames': parameters['Filler Frames'],
+                'background': parameters['Background'].lower(),
+                'color_on': parameters['Color On'],
+                'luminance_on': lum_on_details[0],
+                'color_off': parameters['Luminance Off'],
+                'luminance_off': lum_off_details[0],
+                'notch_filter': parameters['Mains Rejection'],
+                'noise_rejection_passess': extract_number(parameters['Noise Rejection']),
+                'description': 'mferg_{}_{}'.format(parameters['Hexagons'],
+                                                    parameters['Sequence Bits'])}
+    parameters['Protocol'] = 'MfERG_{}'.format(protocol['hex_count'])
+    return protocol
+
+def read_parameters(f, sep, stage=None):
+    """
+    Returns the parameters of an open ExportFile,
+    parsing them only if they have not already been.
+    [stage] - stage timer from profiling.stage_timer
+    """
+    if stage is None:
+        stage = stage_timer(f)
+    if 'params' not in f.sections:
+        with stage('params'):
+            f.sections['params'] = parse_parameters(f, sep)
+    return f.sections['params']
+
+def read_mferg_export_file(filepath, sep='\t', stats=None, on_stage=None,
+                           workers=None):
+    """
+    Parse an mfERG export file.
+    filepath can be a path or an open ExportFile, in which case parameters
+    already parsed from it (e.g. by peek_metadata) are reused.
+    [stats] - profiling.ParseStats filled in with the time taken and rows,
+              bytes and floats read by each stage of the parse
+    [on_stage] - callback called after each stage, see profiling
+    [workers] - number of processes, or an Executor, tokenizing a large
+                block in parallel row ranges, see ExportFile.read_float_block
+    """
+    with open_export_file(filepath) as f:
+        stage = stage_timer(f, stats, on_stage)
+        f.seek(0)
         line = f.readline()
         if not line.strip().split(sep)[0] == 'Parameter':
             raise FileError
-        f.seek(0)
-        parameters = parse_parameters(f, sep)
+        parameters = read_parameters(f, sep, stage)
         hex_count = as_int(parameters['Hexagons'])
-        markers = parse_markers(f, sep)
-        dimensions = parse_dimensions(f, sep)
-        positions = parse_positions(f, sep)
-        data = parse_timeseries(f, hex_count, sep, markers)
-        smooth_details = parse_smooth_string(parameters['Smoothing'])
-        filter_details = parse_filter_string(parameters['Filtering'])
-        lum_on_details = parse_luminance_string(parameters['Luminance On'])
-        lum_off_details = parse_luminance_string(parameters['Luminance Off'])
-        # do this to make these files similar format to ERG and VEP
-        protocol = {'hex_count': parameters['Hexagons'],
-                    'scaled': parameters['Scaled'],
-                    'distortion': parameters['Distortion'],
-                    'filter': parameters['Filter'],
-                    'base_period': extract_number(parameters['Base Period']),
-                    'correlated': extract_number(parameters['Correlated']),
-                    'sequence_len': parameters['Sequence Bits'],
-                    'smoothing_type': smooth_details[0].lower(),
-                    'smoothing_level': smooth_details[1],
-                    'filter_type': filter_details[0].lower(),
-                    'filter_level': filter_details[1],
-                    'filler_frames': parameters['Filler Frames'],
-                    'background': parameters['Background'].lower(),
-                    'color_on': parameters['Color On'],
-                    'luminance_on': lum_on_details[0],
-                    'color_off': parameters['Luminance Off'],
-                    'luminance_off': lum_off_details[0],
-                    'notch_filter': parameters['Mains Rejection'],
-                    'noise_rejection_passess': extract_number(parameters['Noise Rejection']),
-                    'description': 'mferg_{}_{}'.format(parameters['Hexagons'],
-                                                        parameters['Sequence Bits'])}
-    parameters['Protocol'] = 'MfERG_{}'.format(protocol['hex_count'])
+        with stage('columns'):
+            column_index(f, sep)
+        with stage('markers'):
+            markers = parse_markers(f, sep)
+        with stage('dimensions'):
+            dimensions = parse_dimensions(f, sep)
+        with stage('positions'):
+            positions = parse_positions(f, sep)
+        with stage('timeseries'):
+            data = parse_timeseries(f, hex_count, sep, markers, workers=workers)
+        protocol = parse_protocol(parameters)
 
     return({'params': parameters,
             'markers': markers,
@@ -264,6 +379,81 @@ def read_mferg_export_file(filepath, sep='\t'):
             'data': data,
             'stimuli': protocol})
 
+def iter_mferg_timeseries(filepath, sep='\t', eyes=None, hex_ids=None, kinds=None,
+                          block_rows=None):
+    """
+    Generator over the time series in an mfERG export without building
+    the full set of hexagons, see iter_timeseries for the arguments.
+    Pass block_rows to stream the series with bounded memory.
+    """
+    with open_export_file(filepath) as f:
+        f.seek(0)
+        line = f.readline()
+        if not line.strip().split(sep)[0] == 'Parameter':
+            raise FileError
+        parameters = read_parameters(f, sep)
+        yield from iter_timeseries(f, parameters['Hexagons'], sep, eyes=eyes,
+                                   hex_ids=hex_ids, kinds=kinds,
+                                   block_rows=block_rows)
+
+class MfergExport(LazyExport):
+    """
+    An mfERG export whose sections are parsed when first accessed, so
+    reading only the parameters or markers never reads the time series.
+
+        with MfergExport(fname) as export:
+            markers = export.markers
+    """
+    def __init__(self, filepath, sep='\t'):
+        super().__init__(filepath)
+        self.sep = sep
+        try:
+            self.file.seek(0)
+            line = self.file.readline()
+            if not line.strip().split(sep)[0] == 'Parameter':
+                raise FileError
+        except Exception:
+            self.close()
+            raise
+
+    @property
+    def params(self):
+        return self._section('params', lambda: parse_parameters(self.file, self.sep))
+
+    @property
+    def markers(self):
+        return self._section('markers', lambda: parse_markers(self.file, self.sep))
+
+    @property
+    def dims(self):
+        return self._section('dims', lambda: parse_dimensions(self.file, self.sep))
+
+    @property
+    def positions(self):
+        return self._section('positions', lambda: parse_positions(self.file, self.sep))
+
+    @property
+    def data(self):
+        return self._section('data', lambda: parse_timeseries(
+            self.file, as_int(self.params['Hexagons']), self.sep))
+
+    @property
+    def stimuli(self):
+        return self._section('stimuli', lambda: parse_protocol(self.params))
+
+    def as_dict(self):
+        """
+        Parses any remaining sections, returns the same dict as
+        read_mferg_export_file
+        """
+        return({'params': self.params,
+                'markers': self.markers,
+                'dims': self.dims,
+                'positions': self.positions,
+                'data': self.data,
+                'stimuli': self.stimuli})
+
+
 if __name__=='__main__':
     fname = 'data/mferg-Both Eyes-11.22.2017.TXT'
     read_mferg_export_file(fname)
@@ -3,9 +3,12 @@ Code to parse an espion VEP export file
 """
 
 import logging
-import codecs
+import numpy as np
 from .espion_objects import TimeSeries, Result, StepChannel, Step, FileError
-from .utils import as_int, as_float, parse_dateTimeStamp, parse_dateStamp
+from .export_file import LazyExport, open_export_file
+from .profiling import stage_timer
+from .utils import (as_int, as_float, as_float_array, move_top,
+                    parse_dateTimeStamp, parse_dateStamp, read_float_columns)
 logger = logging.getLogger(__name__)
 
 
@@ -14,21 +17,12 @@ def load_file(filepath):
     Load an espion export file, check it's in the correct format.
     Returns a file object or raises a FileError exception.
     """
-    #with open(filepath, 'r') as f:
-    with codecs.open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+    with open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
         line = f.readline()
         if not line.strip().split('\t')[0] == 'Contents Table':
             raise FileError
     return f
 
-def move_top(f, lines):
-    """
-    Takes an open file and moves to the start of lines
-    """
-    f.seek(0)
-    for i in range(lines - 1):
-        f.readline()
-
 def parse_contents(f, sep):
     """
     Read the contents table from an espion export file.
@@ -245,15 +239,128 @@ def parse_stimulus_table(f, contents, sep):
 
     return stimuli
 
-def parse_data_table(f, contents, sep, summary_table):
+MARKER_DTYPE = np.dtype([('step', 'i4'),
+                         ('chan', 'i4'),
+                         ('result', 'i4'),
+                         ('is_average', '?'),
+                         ('eye', 'U4'),
+                         ('name', 'U16'),
+                         ('amp', 'f8'),
+                         ('time', 'f8'),
+                         # [value, +/- range], NaN when the file has no norms
+                         ('amp_norm', 'f8', (2,)),
+                         ('time_norm', 'f8', (2,))])
+
+SUMMARY_DTYPE = np.dtype([('step', 'i4'),
+                          ('result', 'i4'),
+                          ('eye', 'U4'),
+                          ('trials', 'i4'),
+                          ('rejects', 'i4'),
+                          ('comment', 'O')])
+
+def _read_section_rows(f, locations, sep):
     """
-    Read the data table.
-    Does this by reading an entire line then splitting the values and appending 
-    them to the individual trials.
-    done this way so we only loop through the file once instead of
-    once per trial
+    Returns the rows of a section as lists of strings, up to the first
+    empty row
+    """
+    move_top(f, locations['top'])
+    rows = []
+    while True:
+        line = f.readline().rstrip('\r\n')
+        values = line.split(sep)[locations['left']-1:locations['right']]
+        if ''.join(values) == '':
+            break
+        rows.append(values)
+    return rows
+
+def _norm_column(column):
+    """
+    Splits 'value+/-range' strings into an (n, 2) float array
+    """
+    norms = np.full((len(column), 2), np.nan)
+    for idx, norm in enumerate(column):
+        parts = norm.split('+/-')
+        if len(parts) == 2:
+            norms[idx] = as_float_array(parts)
+    return norms
+
+def parse_marker_array(f, contents, sep, version):
+    """
+    Read the marker table into a structured array with MARKER_DTYPE,
+    one record per marker, rather than the dict of lists of dicts
+    returned by parse_marker_section.
+    Missing amplitudes and times are NaN.
+    Arrays from several files can be joined with utils.stack_tables
+    and filtered with boolean masks, e.g.
+        markers[(markers['name'] == 'b') & markers['is_average']]
+    """
+    logger.debug('Parsing marker table')
+    if not 'Marker Table' in contents.keys():
+        raise FileError
+
+    locations = contents['Marker Table']
+    rows = _read_section_rows(f, locations, sep)
+    # the 6.64.14 layout has an extra comment column in the patient details
+    first = 6 if version else 5
+    if version:
+        has_norms = locations['right'] - locations['left'] == 13
+    else:
+        has_norms = locations['right'] - locations['left'] == 14
+
+    markers = np.zeros(len(rows), dtype=MARKER_DTYPE)
+    if not rows:
+        return markers
+    columns = list(zip(*rows))
+    markers['step'] = [int(val) for val in columns[first]]
+    markers['chan'] = [as_int(val) or 0 for val in columns[first + 1]]
+    results = columns[first + 2]
+    markers['is_average'] = [val.endswith('A') for val in results]
+    markers['result'] = [as_int(val[:-1] if val.endswith('A') else val) or 0
+                         for val in results]
+    markers['eye'] = columns[first + 3]
+    markers['name'] = columns[first + 4]
+    markers['amp'] = as_float_array(columns[first + 5])
+    if has_norms:
+        markers['amp_norm'] = _norm_column(columns[first + 6])
+        markers['time'] = as_float_array(columns[first + 7])
+        markers['time_norm'] = _norm_column(columns[first + 8])
+    else:
+        markers['time'] = as_float_array(columns[first + 6])
+        markers['amp_norm'] = np.nan
+        markers['time_norm'] = np.nan
+    return markers
+
+def parse_summary_array(f, contents, sep):
+    """
+    Read the summary table into a structured array with SUMMARY_DTYPE,
+    one record per step result.
+    """
+    logger.debug('Parsing summary table')
+    if not 'Summary Table' in contents.keys():
+        raise FileError
+
+    rows = _read_section_rows(f, contents['Summary Table'], sep)
+    summary = np.zeros(len(rows), dtype=SUMMARY_DTYPE)
+    if not rows:
+        return summary
+    columns = list(zip(*rows))
+    summary['step'] = [int(val) for val in columns[2]]
+    summary['result'] = [int(val) for val in columns[3]]
+    summary['eye'] = columns[4]
+    summary['trials'] = [int(val) for val in columns[5]]
+    summary['rejects'] = [int(val) for val in columns[6]]
+    summary['comment'] = columns[8]
+    return summary
+
+def data_table_layout(f, contents, sep, steps=None, channels=None,
+                      include_trials=True):
+    """
+    Read the step summary at the left of the data table.
+    Returns (data, columns), data is the step -> channel -> result
+    structure without any values, columns the sorted file columns
+    (0 based) holding the requested times, averages and trials.
+    See parse_data_table for the arguments.
     """
-    logger.debug('Parsing data table')
     if not 'Data Table' in contents.keys():
         raise FileError('Data table not found')
 
@@ -315,60 +422,206 @@ def parse_data_table(f, contents, sep, summary_table):
     headers = f.readline()
     headers = headers.split(sep)
 
-    # need firt two lines to determine timeseries parameters
-    line_one = f.readline()
-    line_one = line_one.split(sep)
-    line_two = f.readline()
-    line_two = line_two.split(sep)
+    if steps is not None:
+        data = {step_id: step for step_id, step in data.items()
+                if step_id in steps}
+    if channels is not None:
+        for step_id, step in data.items():
+            step.channels = {channel_id: channel
+                             for channel_id, channel in step.channels.items()
+                             if channel_id in channels}
 
+    # collect every column we need so the whole block is converted to floats
+    # in one go, rather than appending one value at a time
+    columns = set()
     for step_id, step in data.items():
-        time_start = float(line_one[step.column - 1])
-        time_delta = float(line_two[step.column - 1]) - time_start
+        columns.add(step.column - 1)
         for channel_id, channel in step.channels.items():
             for result_id, result in channel.results.items():
-                result.data = TimeSeries(time_start, time_delta)
-                result.data.values.append(float(line_one[result.column - 1]))
-                result.data.values.append(float(line_two[result.column - 1]))
-
                 for trial_no in range(result.trial_count):
                     if headers[result.column + trial_no] != 'Trial (nV)':
                         result.trial_count = trial_no
                         break
-                    result.trials.append(TimeSeries(time_start, time_delta))
-                    result.trials[trial_no].values.append(float(line_one[result.column + trial_no]))
-                    result.trials[trial_no].values.append(float(line_two[result.column + trial_no]))
+                columns.add(result.column - 1)
+                if include_trials:
+                    columns.update(range(result.column,
+                                         result.column + result.trial_count))
+    columns = sorted(columns)
+    return data, columns
+
+def parse_data_table(f, contents, sep, summary_table, steps=None,
+                     channels=None, include_trials=True, workers=None):
+    """
+    Read the data table.
+    The columns holding the times, averages and trials are read in a
+    single pass into one float array, each TimeSeries is a view onto
+    a row of that array rather than a list of floats.
+    [steps] - step numbers to read, defaults to all
+    [channels] - channel numbers to read, defaults to all
+    [include_trials] - if False only the averages are read and
+                       Result.trials is left empty
+    Columns that are not requested are never converted to floats.
+    [workers] - number of processes, or an Executor, tokenizing a large
+                block in parallel row ranges, see ExportFile.read_float_block
+    """
+    logger.debug('Parsing data table')
+    data, columns = data_table_layout(f, contents, sep, steps=steps,
+                                      channels=channels,
+                                      include_trials=include_trials)
+    locations = contents['Data Table']
+    block = read_float_columns(f, locations['top'], columns, sep,
+                               workers=workers)
+    block_row = {col: idx for idx, col in enumerate(columns)}
 
-    while True:
-        values = f.readline()
-        values = values.split(sep)
-        if ''.join(values) == '':
-            break
+    for step_id, step in data.items():
+        times = block[block_row[step.column - 1]]
+        time_start = float(times[0])
+        time_delta = float(times[1]) - time_start
+        # a later step may have a longer time series, leaving empty cells
+        # at the end of this step. Only rows past its last time are
+        # trimmed, any empty cell of a result before that stays as NaN.
+        valid = np.flatnonzero(~np.isnan(times))
+        length = int(valid[-1]) + 1 if len(valid) else 0
+        for channel_id, channel in step.channels.items():
+            for result_id, result in channel.results.items():
+                values = block[block_row[result.column - 1]]
+                result.data = TimeSeries(time_start, time_delta, values[:length])
+                first = block_row[result.column - 1] + 1
+                if include_trials:
+                    result.trials = TimeSeries(
+                        time_start, time_delta,
+                        block[first:first + result.trial_count, :length])
+    return(data)
+
+def stream_data_table(filepath, sink, sep='\t', block_rows=256, steps=None,
+                      channels=None, include_trials=True):
+    """
+    Read the data table of a VEP/ERG export block_rows samples at a time,
+    handing each block of every result and trial to sink instead of
+    keeping it, so memory use depends on block_rows rather than the size
+    of the file.
+    sink(step, channel, result, trial, series) is called for every block,
+    trial is 0 for the average and counts from 1 for the trials, series
+    is a TimeSeries of the block's samples starting at their time.
+    Samples past the end of a shorter step are not passed on.
+    steps, channels and include_trials are as for parse_data_table.
+    Returns the step -> channel -> result structure from
+    data_table_layout, without any values.
+
+    e.g. to write each average straight to its own file
+        def sink(step, channel, result, trial, series):
+            if trial == 0:
+                with open('{}-{}-{}.f64'.format(step, channel, result), 'ab') as f:
+                    f.write(series.values.tobytes())
+    """
+    with open_export_file(filepath) as f:
+        f.seek(0)
+        line = f.readline()
+        if not line.strip().split(sep)[0] == 'Contents Table':
+            raise FileError
+        contents, header = read_contents_and_header(f, sep)
+        data, columns = data_table_layout(f, contents, sep, steps=steps,
+                                          channels=channels,
+                                          include_trials=include_trials)
+        block_row = {col: idx for idx, col in enumerate(columns)}
+        # (step, channel, result, trial, values row, time row) of each series
+        targets = []
         for step_id, step in data.items():
+            time_row = block_row[step.column - 1]
             for channel_id, channel in step.channels.items():
                 for result_id, result in channel.results.items():
-                    if values[result.column - 1] == '':
-                        # have a problem here if a subsequent step has a longer time series
-                        continue
-                    result.data.values.append(float(values[result.column - 1]))
-
-                    for trial_no in range(result.trial_count):
-                        result.trials[trial_no].values.append(float(values[result.column + (trial_no)]))
-    return(data)
-
-def read_export_file(filepath, sep='\t'):
+                    targets.append((step_id, channel_id, result_id, 0,
+                                    block_row[result.column - 1], time_row))
+                    if include_trials:
+                        for trial_no in range(1, result.trial_count + 1):
+                            targets.append((step_id, channel_id, result_id, trial_no,
+                                            block_row[result.column - 1 + trial_no],
+                                            time_row))
+        # start and sample interval of each step, from its first two times
+        # so they do not depend on block_rows
+        time_rows = sorted({target[5] for target in targets})
+        timing = {}
+        for _, times in f.iter_float_blocks(contents['Data Table']['top'],
+                                            [columns[row] for row in time_rows],
+                                            sep, 2):
+            for time_row, step_times in zip(time_rows, times):
+                delta = float(step_times[1] - step_times[0]) if len(step_times) > 1 else 0.0
+                timing[time_row] = (float(step_times[0]), delta)
+            break
+        for first, block in f.iter_float_blocks(contents['Data Table']['top'],
+                                                columns, sep, block_rows):
+            # the rows of a step are those with a time, empty cells of a
+            # result within them are passed on as NaN
+            lengths = {}
+            for time_row in time_rows:
+                valid = np.flatnonzero(~np.isnan(block[time_row]))
+                lengths[time_row] = int(valid[-1]) + 1 if len(valid) else 0
+            for step_id, channel_id, result_id, trial_no, row, time_row in targets:
+                length = lengths[time_row]
+                if not length:
+                    continue
+                start, delta = timing[time_row]
+                sink(step_id, channel_id, result_id, trial_no,
+                     TimeSeries(start + first * delta, delta, block[row, :length]))
+    return data
+
+def read_contents_and_header(f, sep, stage=None):
+    """
+    Returns the contents and header tables of an open ExportFile,
+    parsing them only if they have not already been.
+    [stage] - stage timer from profiling.stage_timer
+    """
+    if stage is None:
+        stage = stage_timer(f)
+    if 'contents' not in f.sections:
+        with stage('contents'):
+            f.seek(0)
+            f.sections['contents'] = parse_contents(f, sep)
+    if 'headers' not in f.sections:
+        with stage('headers'):
+            f.sections['headers'] = parse_header_section(f, f.sections['contents'], sep)
+    return f.sections['contents'], f.sections['headers']
+
+def read_export_file(filepath, sep='\t', steps=None, channels=None,
+                     include_trials=True, tables=False, stats=None,
+                     on_stage=None, workers=None):
+    """
+    Parse a VEP/ERG export file.
+    filepath can be a path or an open ExportFile, sections already parsed
+    from an ExportFile (e.g. by peek_metadata) are reused.
+    steps, channels and include_trials limit which parts of the data
+    table are read, see parse_data_table.
+    [tables] - if True markers and summary are structured arrays, see
+               parse_marker_array and parse_summary_array
+    [stats] - profiling.ParseStats filled in with the time taken and rows,
+              bytes and floats read by each stage of the parse
+    [on_stage] - callback called after each stage, see profiling
+    [workers] - number of processes, or an Executor, tokenizing a large
+                block in parallel row ranges, see ExportFile.read_float_block
+    """
     logger.debug('Reading file:{}'.format(filepath))
-    #with open(filepath, 'r') as f:
-    with codecs.open(filepath, 'r', encoding='utf-8', errors='ignore') as f:
+    with open_export_file(filepath) as f:
+        stage = stage_timer(f, stats, on_stage)
+        f.seek(0)
         line = f.readline()
         if not line.strip().split(sep)[0] == 'Contents Table':
             raise FileError
-        f.seek(0)
-        contents = parse_contents(f, sep)
-        header = parse_header_section(f, contents, sep)
-        markers = parse_marker_section(f, contents, sep, header.get('Version'))
-        summary = parse_summary_table(f, contents, sep)
-        stimuli = parse_stimulus_table(f, contents, sep)
-        data = parse_data_table(f, contents, sep, summary)
+        contents, header = read_contents_and_header(f, sep, stage)
+        if tables:
+            parse_markers, parse_summary = parse_marker_array, parse_summary_array
+        else:
+            parse_markers, parse_summary = parse_marker_section, parse_summary_table
+        with stage('markers'):
+            markers = parse_markers(f, contents, sep, header.get('Version'))
+        with stage('summary'):
+            summary = parse_summary(f, contents, sep)
+        with stage('stimuli'):
+            stimuli = parse_stimulus_table(f, contents, sep)
+        with stage('data'):
+            data = parse_data_table(f, contents, sep, summary, steps=steps,
+                                    channels=channels,
+                                    include_trials=include_trials,
+                                    workers=workers)
     return({'contents':contents,
             'headers':header,
             'markers':markers,
@@ -377,6 +630,94 @@ def read_export_file(filepath, sep='\t'):
             'data':data})
 
 
+class EspionExport(LazyExport):
+    """
+    A VEP/ERG export whose sections are parsed when first accessed, so
+    reading only the headers or markers never touches the data table.
+
+        with EspionExport(fname) as export:
+            markers = export.markers
+
+    steps, channels, include_trials and tables are as for read_export_file.
+    Sections are kept in the ExportFile's sections dict, objects sharing
+    an ExportFile share its parsed sections. The data is kept per set of
+    steps, channels and include_trials, so objects reading different
+    parts of the data table each get their own.
+    """
+    def __init__(self, filepath, sep='\t', steps=None, channels=None,
+                 include_trials=True, tables=False):
+        super().__init__(filepath)
+        self.sep = sep
+        self.steps = steps
+        self.channels = channels
+        self.include_trials = include_trials
+        self.tables = tables
+        try:
+            self.file.seek(0)
+            line = self.file.readline()
+            if not line.strip().split(sep)[0] == 'Contents Table':
+                raise FileError
+        except Exception:
+            self.close()
+            raise
+
+    def _contents_and_header(self):
+        if self._context is None:
+            raise ValueError('{} is closed'.format(self))
+        return read_contents_and_header(self.file, self.sep)
+
+    @property
+    def contents(self):
+        return self._contents_and_header()[0]
+
+    @property
+    def headers(self):
+        return self._contents_and_header()[1]
+
+    @property
+    def markers(self):
+        if self.tables:
+            return self._section('marker_table', lambda: parse_marker_array(
+                self.file, self.contents, self.sep, self.headers.get('Version')))
+        return self._section('markers', lambda: parse_marker_section(
+            self.file, self.contents, self.sep, self.headers.get('Version')))
+
+    @property
+    def summary(self):
+        if self.tables:
+            return self._section('summary_table', lambda: parse_summary_array(
+                self.file, self.contents, self.sep))
+        return self._section('summary', lambda: parse_summary_table(
+            self.file, self.contents, self.sep))
+
+    @property
+    def stimuli(self):
+        return self._section('stimuli', lambda: parse_stimulus_table(
+            self.file, self.contents, self.sep))
+
+    @property
+    def data(self):
+        key = ('data',
+               None if self.steps is None else tuple(self.steps),
+               None if self.channels is None else tuple(self.channels),
+               bool(self.include_trials))
+        return self._section(key, lambda: parse_data_table(
+            self.file, self.contents, self.sep, self.summary, steps=self.steps,
+            channels=self.channels, include_trials=self.include_trials))
+
+    def as_dict(self):
+        """
+        Parses any remaining sections, returns the same dict as
+        read_export_file
+        """
+        return({'contents':self.contents,
+                'headers':self.headers,
+                'markers':self.markers,
+                'summary':self.summary,
+                'stimuli':self.stimuli,
+                'data':self.data})
+
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
     filepath = "../../samples/erg_protocol_1.2_version_6.64.14.txt"
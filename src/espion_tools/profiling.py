@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Per stage timing of the export parsers.
+
+read_export_file and read_mferg_export_file take a ParseStats to fill in
+and/or an on_stage callback, called as on_stage(filepath, record) after
+each stage with a record like
+    {'stage': 'markers', 'seconds': 0.002, 'rows': 120, 'bytes': 9600,
+     'floats': 0}
+rows and bytes count what was read from the file during the stage and
+floats the number of cells converted by the bulk float readers.
+When neither is given the stages are not timed at all.
+"""
+import contextlib
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+_NULL_STAGE = contextlib.nullcontext()
+
+
+class ParseStats():
+    """
+    Records of each stage of a parse, in the order they ran
+    """
+    def __init__(self):
+        self.filepath = None
+        self.stages = []
+
+    def __repr__(self):
+        return 'ParseStats({!r}, {:.4f}s)'.format(self.filepath,
+                                                  self.total()['seconds'])
+
+    def __getitem__(self, stage):
+        """
+        Returns the record of the named stage
+        """
+        for record in self.stages:
+            if record['stage'] == stage:
+                return record
+        raise KeyError(stage)
+
+    def total(self):
+        """
+        Returns a record summing every stage
+        """
+        total = {'stage': 'total', 'seconds': 0.0, 'rows': 0, 'bytes': 0,
+                 'floats': 0}
+        for record in self.stages:
+            for key in ('seconds', 'rows', 'bytes', 'floats'):
+                total[key] += record[key]
+        return total
+
+    def slowest(self):
+        """
+        Returns the record of the stage that took longest, or None
+        """
+        if not self.stages:
+            return None
+        return max(self.stages, key=lambda record: record['seconds'])
+
+
+def _counters(f):
+    return (getattr(f, 'rows_read', 0), getattr(f, 'bytes_read', 0),
+            getattr(f, 'floats_read', 0))
+
+
+@contextlib.contextmanager
+def _timed_stage(f, name, stats, on_stage):
+    rows, nbytes, floats = _counters(f)
+    start = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - start
+    end_rows, end_bytes, end_floats = _counters(f)
+    record = {'stage': name,
+              'seconds': elapsed,
+              'rows': end_rows - rows,
+              'bytes': end_bytes - nbytes,
+              'floats': end_floats - floats}
+    if stats is not None:
+        stats.stages.append(record)
+    if on_stage is not None:
+        on_stage(getattr(f, 'filepath', None), record)
+
+
+def stage_timer(f, stats=None, on_stage=None):
+    """
+    Returns a function taking a stage name that gives a context manager
+    timing the stage, used as
+        stage = stage_timer(f, stats, on_stage)
+        with stage('markers'):
+            ...
+    f - the ExportFile being parsed, its read counters are sampled
+        before and after each stage
+    If stats and on_stage are both None nothing is measured.
+    """
+    if stats is None and on_stage is None:
+        return lambda name: _NULL_STAGE
+    if stats is not None:
+        stats.filepath = getattr(f, 'filepath', None)
+    return lambda name: _timed_stage(f, name, stats, on_stage)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+Hand parsed exports between processes through shared memory.
+
+A worker calls share() on the parsed data, which writes the values of
+every TimeSeries into one multiprocessing.shared_memory block and
+returns a SharedExport. The SharedExport only pickles the block name
+and a small description of the data, so returning it from a worker
+process costs the same however many waveforms the export holds.
+The receiving process calls load() to get the data back.
+
+    # in the worker
+    return share(load_file(fpath))
+    # in the parent
+    info, data = shared_export.load()
+
+Every block must be loaded (or unlinked) exactly once, otherwise it stays
+allocated until the machine restarts.
+"""
+import io
+import logging
+import os
+import pickle
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from .espion_objects import TimeSeries
+
+logger = logging.getLogger(__name__)
+
+
+class _SeriesPickler(pickle.Pickler):
+    """
+    Pickles everything but TimeSeries, which are collected and replaced
+    by their index
+    """
+    def __init__(self, f):
+        super().__init__(f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.series = []
+
+    def persistent_id(self, obj):
+        if type(obj) is TimeSeries:
+            self.series.append(obj)
+            return len(self.series) - 1
+        return None
+
+
+class _SeriesUnpickler(pickle.Unpickler):
+    def __init__(self, f, series):
+        super().__init__(f)
+        self.series = series
+
+    def persistent_load(self, pid):
+        return self.series(pid)
+
+
+class SharedExport():
+    """
+    Picklable descriptor of data held in a shared memory block, see the
+    module docstring.
+    name - name of the shared memory block
+    body - pickle of the data with each TimeSeries replaced by an index
+    layout - float array, one row per series of
+             (start, delta, offset, rows, columns), rows is -1 for 1-D values
+    """
+    def __init__(self, name, body, layout):
+        self.name = name
+        self.body = body
+        self.layout = layout
+        self._shm = None
+
+    def __repr__(self):
+        return 'SharedExport(name={!r}, series={})'.format(self.name, len(self.layout))
+
+    def __getstate__(self):
+        return {'name': self.name, 'body': self.body, 'layout': self.layout}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @property
+    def nbytes(self):
+        """
+        Size of the shared block's values in bytes
+        """
+        if not len(self.layout):
+            return 0
+        offset, rows, columns = self.layout[-1, 2:]
+        size = columns if rows < 0 else rows * columns
+        return int(offset + size) * 8
+
+    def load(self, copy=True):
+        """
+        Rebuild the shared data.
+        copy - if True the values are copied out in one block and the
+               shared memory is released. If False each TimeSeries is a
+               view onto the shared memory, which stays allocated until
+               close() is called; the series must not be used after that.
+        """
+        shm = shared_memory.SharedMemory(name=self.name) if self.name else None
+        values = None
+        try:
+            count = self.nbytes // 8
+            if shm is None:
+                values = np.empty(0)
+            else:
+                values = np.ndarray((count,), dtype=np.float64, buffer=shm.buf)
+                if copy:
+                    values = values.copy()
+
+            def series(idx):
+                start, delta, offset, rows, columns = self.layout[idx]
+                offset, rows, columns = int(offset), int(rows), int(columns)
+                if rows >= 0:
+                    block = values[offset:offset + rows * columns].reshape(rows, columns)
+                else:
+                    block = values[offset:offset + columns]
+                return TimeSeries(float(start), float(delta), block)
+
+            data = _SeriesUnpickler(io.BytesIO(self.body), series).load()
+        except BaseException:
+            del values
+            self._release(shm)
+            raise
+        if copy:
+            del values
+            self._release(shm)
+        else:
+            self._shm = shm
+        return data
+
+    def close(self):
+        """
+        Release the shared memory of data loaded with copy=False, the
+        data must be deleted first or a BufferError is raised
+        """
+        shm, self._shm = self._shm, None
+        self._release(shm)
+
+    def unlink(self):
+        """
+        Release the shared memory without loading it, e.g. if the data
+        is no longer wanted
+        """
+        if self.name:
+            try:
+                shm = shared_memory.SharedMemory(name=self.name)
+            except FileNotFoundError:
+                return
+            self._release(shm)
+
+    @staticmethod
+    def _release(shm):
+        if shm is None:
+            return
+        try:
+            shm.close()
+        finally:
+            try:
+                shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+def share(data):
+    """
+    Write the TimeSeries values of data, e.g. the return value of
+    load_file, into a new shared memory block.
+    Returns a SharedExport, the caller is responsible for passing it to a
+    process that loads it.
+    """
+    f = io.BytesIO()
+    pickler = _SeriesPickler(f)
+    pickler.dump(data)
+    layout = np.zeros((len(pickler.series), 5))
+    offset = 0
+    for idx, ts in enumerate(pickler.series):
+        shape = ts.values.shape
+        rows, columns = (shape[0], shape[1]) if len(shape) > 1 else (-1, shape[0])
+        layout[idx] = (ts.start, ts.delta, offset, rows, columns)
+        offset += ts.values.size
+    if not offset:
+        return SharedExport(None, f.getvalue(), layout)
+
+    shm = shared_memory.SharedMemory(create=True, size=offset * 8)
+    try:
+        values = np.ndarray((offset,), dtype=np.float64, buffer=shm.buf)
+        for row, ts in zip(layout, pickler.series):
+            start = int(row[2])
+            values[start:start + ts.values.size] = ts.values.ravel()
+        del values
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+    shm.close()
+    if os.name == 'posix':
+        # the block belongs to the process that loads it, which registers
+        # it again when attaching. Left registered here it would be
+        # removed when this process exits, possibly before being loaded.
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    return SharedExport(shm.name, f.getvalue(), layout)
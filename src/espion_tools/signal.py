@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+Batch signal processing of parsed time series.
+
+Each function works on a TimeSeries whose values are 1-D or 2-D, a 2-D
+series (e.g. Result.trials, or the hexagons of an mfERG eye stacked with
+hexagon_series) is processed one row per waveform in a single numpy
+operation. Times are in ms as exported, filter cutoffs in Hz.
+
+    hex_ids, raw = hexagon_series(data['data'], 'od')
+    raw = baseline_correct(filter_series(raw, lowpass=100))
+    found = detect_n1_p1(raw)
+    exported = hexagon_markers(data['markers'], 'od', hex_ids)
+    error = found['n1_time'] - exported['n1_time']
+"""
+import logging
+import numpy as np
+from .espion_objects import Result, TimeSeries
+from .utils import as_float_array
+
+logger = logging.getLogger(__name__)
+
+
+def stack(series):
+    """
+    Combines equally sampled 1-D TimeSeries into one 2-D TimeSeries
+    """
+    series = list(series)
+    if not series:
+        raise ValueError('No series to stack')
+    first = series[0]
+    for other in series[1:]:
+        if other.start != first.start or other.delta != first.delta:
+            raise ValueError('Series do not share a time axis')
+    return TimeSeries(first.start, first.delta, np.vstack([s.values for s in series]))
+
+
+def hexagon_series(data, eye, kind='raw'):
+    """
+    Stacks the time series of every hexagon of one eye of an mfERG export.
+    data - the 'data' dict of read_mferg_export_file
+    kind - 'raw' or 'smooth'
+    Returns (hex_ids, TimeSeries) with one row per hexagon in hex_ids order.
+    """
+    series = data[eye][kind]
+    hex_ids = np.array(sorted(series))
+    return hex_ids, stack(series[hex_id] for hex_id in hex_ids)
+
+
+def hexagon_markers(markers, eye, hex_ids):
+    """
+    The exported N1 and P1 markers of one eye as arrays in hex_ids order,
+    with the same keys as detect_n1_p1. Missing values are NaN.
+    markers - the 'markers' dict of read_mferg_export_file
+    """
+    side = 0 if eye == 'od' else 1
+    hexagons = [markers[str(hex_id)][side] for hex_id in hex_ids]
+    if any(hexagon is None for hexagon in hexagons):
+        raise ValueError('No markers for eye:{}'.format(eye))
+    return {'n1_amp': as_float_array([h.n1[0] for h in hexagons]),
+            'n1_time': as_float_array([h.n1[1] for h in hexagons]),
+            'p1_amp': as_float_array([h.p1[0] for h in hexagons]),
+            'p1_time': as_float_array([h.p1[1] for h in hexagons])}
+
+
+def _window(series, window):
+    """
+    Boolean mask of the samples of series inside window (start, end) in ms
+    """
+    time = series.time
+    return (time >= window[0]) & (time <= window[1])
+
+
+def baseline_correct(series, window=None):
+    """
+    Subtracts the mean of each waveform over window (start, end) in ms.
+    The default window is the pre-stimulus interval (time < 0), or the
+    first sample if the series starts at or after the stimulus.
+    """
+    if window is None:
+        mask = series.time < 0
+        if not mask.any():
+            mask[:1] = True
+    else:
+        mask = _window(series, window)
+        if not mask.any():
+            raise ValueError('Baseline window {} is outside the series'.format(window))
+    baseline = series.values[..., mask].mean(axis=-1, keepdims=True)
+    return TimeSeries(series.start, series.delta, series.values - baseline)
+
+
+def filter_series(series, lowpass=None, highpass=None, order=2):
+    """
+    Zero phase Butterworth filter, applied in the frequency domain to
+    every waveform at once.
+    lowpass, highpass - cutoff frequencies in Hz, either can be None
+    order - filter order, the gain is that of an order Butterworth
+            filter applied forwards and backwards
+    The series is mirrored at both ends before filtering to limit edge
+    effects.
+    """
+    values = series.values
+    samples = values.shape[-1]
+    if samples < 2 or (lowpass is None and highpass is None):
+        return TimeSeries(series.start, series.delta, values.copy())
+    pad = samples - 1
+    widths = [(0, 0)] * (values.ndim - 1) + [(pad, pad)]
+    padded = np.pad(values, widths, mode='reflect')
+    freqs = np.fft.rfftfreq(padded.shape[-1], d=series.delta / 1000.0)
+    gain = np.ones_like(freqs)
+    if lowpass is not None:
+        gain /= 1 + (freqs / lowpass) ** (2 * order)
+    if highpass is not None:
+        with np.errstate(divide='ignore'):
+            gain /= 1 + (highpass / freqs) ** (2 * order)
+    filtered = np.fft.irfft(np.fft.rfft(padded, axis=-1) * gain,
+                            n=padded.shape[-1], axis=-1)
+    return TimeSeries(series.start, series.delta, filtered[..., pad:pad + samples])
+
+
+def resample(series, delta):
+    """
+    Linearly interpolates every waveform onto a new sample interval
+    delta in ms, over the same time span.
+    When reducing the sample rate low pass filter first to avoid aliasing.
+    """
+    samples = series.values.shape[-1]
+    if samples < 2:
+        return TimeSeries(series.start, delta, series.values.copy())
+    span = (samples - 1) * series.delta
+    count = int(np.floor(span / delta + 1e-9)) + 1
+    positions = np.arange(count) * (delta / series.delta)
+    lower = np.minimum(positions.astype(int), samples - 2)
+    fraction = positions - lower
+    values = series.values
+    resampled = (values[..., lower] * (1 - fraction)
+                 + values[..., lower + 1] * fraction)
+    return TimeSeries(series.start, delta, resampled)
+
+
+def reaverage(trials, threshold=None, window=None, scale=1.0):
+    """
+    Averages trials, rejecting any whose absolute amplitude exceeds
+    threshold.
+    trials - a 2-D TimeSeries, or a Result whose trials are used
+    threshold - in the units of the trials (nV for VEP/ERG exports),
+                None keeps every trial
+    window - (start, end) in ms to test against threshold, defaults to
+             the whole trial
+    scale - multiplies the average, e.g. 0.001 for an average in uV
+            from trials in nV
+    Trials containing NaN are always rejected.
+    Returns (TimeSeries, accepted) where accepted is a boolean array
+    with an entry per trial.
+    """
+    if isinstance(trials, Result):
+        trials = trials.trials
+    values = np.atleast_2d(trials.values)
+    tested = values if window is None else values[:, _window(trials, window)]
+    accepted = ~np.isnan(tested).any(axis=1)
+    if threshold is not None:
+        accepted &= np.abs(np.nan_to_num(tested)).max(axis=1, initial=0) <= threshold
+    if accepted.any():
+        average = values[accepted].mean(axis=0) * scale
+    else:
+        logger.debug('Every trial rejected')
+        average = np.full(values.shape[-1], np.nan)
+    return TimeSeries(trials.start, trials.delta, average), accepted
+
+
+def trough_peak(series, trough_window, peak_window):
+    """
+    Finds the minimum of each waveform in trough_window and the following
+    maximum in peak_window, windows are (start, end) in ms and the peak is
+    only searched for after the trough.
+    Returns a dict of arrays (scalars for a 1-D series)
+        trough_amp - trough measured from zero
+        trough_time
+        peak_amp - peak measured from the trough
+        peak_time
+    NaN where a window contains no valid samples.
+    """
+    values = np.atleast_2d(series.values)
+    time = series.time
+    # NaN samples, e.g. the padding of stacked shorter waveforms, are skipped
+    valid = ~np.isnan(values)
+    in_trough = _window(series, trough_window)[None, :] & valid
+    trough_values = np.where(in_trough, values, np.inf)
+    trough_idx = trough_values.argmin(axis=1)
+    trough_amp = values[np.arange(len(values)), trough_idx]
+    trough_time = time[trough_idx]
+
+    in_peak = (_window(series, peak_window)[None, :] & valid
+               & (time[None, :] >= trough_time[:, None]))
+    peak_values = np.where(in_peak, values, -np.inf)
+    peak_idx = peak_values.argmax(axis=1)
+    peak_amp = values[np.arange(len(values)), peak_idx] - trough_amp
+    peak_time = time[peak_idx]
+
+    has_trough = in_trough.any(axis=1)
+    has_peak = in_peak.any(axis=1) & has_trough
+    found = {'trough_amp': np.where(has_trough, trough_amp, np.nan),
+             'trough_time': np.where(has_trough, trough_time, np.nan),
+             'peak_amp': np.where(has_peak, peak_amp, np.nan),
+             'peak_time': np.where(has_peak, peak_time, np.nan)}
+    if series.values.ndim < 2:
+        found = {key: float(value[0]) for key, value in found.items()}
+    return found
+
+
+def detect_n1_p1(series, n1_window=(8, 25), p1_window=(20, 50)):
+    """
+    mfERG N1 and P1 of every hexagon, N1 measured from zero and P1 from
+    N1, as in the exported markers.
+    Returns a dict with keys n1_amp, n1_time, p1_amp, p1_time.
+    """
+    found = trough_peak(series, n1_window, p1_window)
+    return {'n1_amp': found['trough_amp'], 'n1_time': found['trough_time'],
+            'p1_amp': found['peak_amp'], 'p1_time': found['peak_time']}
+
+
+def detect_a_b_wave(series, a_window=(5, 40), b_window=(20, 120)):
+    """
+    ERG a- and b-waves, the a-wave measured from zero and the b-wave
+    from the a-wave trough.
+    Returns a dict with keys a_amp, a_time, b_amp, b_time.
+    """
+    found = trough_peak(series, a_window, b_window)
+    return {'a_amp': found['trough_amp'], 'a_time': found['trough_time'],
+            'b_amp': found['peak_amp'], 'b_time': found['peak_time']}
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+A cohort wide store of parsed waveforms.
+
+Every waveform added is appended to one float64 file, values.f64, which
+is memory mapped for reading, and described by a record in index.bin
+with INDEX_DTYPE (file, step, channel, eye, result, trial, hexagon and
+where its values are). The fields shared by every waveform of an export
+(patient, date, test type, protocol and source path) are written once
+per export to files.jsonl, and records refer to them by file id. All
+three files are only ever appended to, so a store can grow daily
+without rewriting it. When a source is added again, e.g. a re-exported
+file, its earlier file entry and records are superseded and left out of
+queries.
+
+    store = WaveformStore('cohort/')
+    store.add_file('exports/patient1.txt')
+    records, values = store.query(test_type='erg', step=4, eye='OD',
+                                  date_from='2019-01-01', date_to='2024-12-31')
+
+records holds the index fields joined with the file fields of each
+waveform. values is a 2-D array with one row per record, padded with NaN
+where waveforms differ in length.
+"""
+from datetime import datetime
+import json
+import logging
+import os
+import numpy as np
+from . import parse_espion_export
+from .ingest import file_hash
+
+logger = logging.getLogger(__name__)
+
+INDEX_DTYPE = np.dtype([# position of the export in the file table
+                        ('file', 'i4'),
+                        ('step', 'i4'),
+                        ('channel', 'i4'),
+                        ('eye', 'U4'),
+                        ('result', 'i4'),
+                        # trial number from 1, 0 for an average
+                        ('trial', 'i4'),
+                        ('hexagon', 'i4'),
+                        # 'data' or 'trial' for VEP/ERG, 'raw' or 'smooth' for mfERG
+                        ('kind', 'U8'),
+                        ('start', 'f8'),
+                        ('delta', 'f8'),
+                        ('offset', 'i8'),
+                        ('length', 'i8')])
+
+# fields of the file table, kept per export rather than per waveform
+FILE_FIELDS = ('hosp', 'date', 'test_type', 'protocol', 'source')
+# recorded for files added with add_file, to tell when they change
+FILE_STATE_FIELDS = ('size', 'mtime_ns', 'sha256')
+
+# value used for fields that do not apply, e.g. hexagon of an ERG
+MISSING = -1
+
+
+def _date(value):
+    if value is None or value == '':
+        return np.datetime64('NaT')
+    if isinstance(value, datetime):
+        return np.datetime64(value.replace(tzinfo=None), 's')
+    return np.datetime64(value, 's')
+
+
+def _channel_eyes(markers, summary):
+    """
+    Returns {(step, channel): eye} from the marker table, which records
+    the eye of each channel, and {(step, result): eye} from the summary
+    """
+    channel_eyes = {}
+    if isinstance(markers, np.ndarray):
+        for marker in markers:
+            channel_eyes.setdefault((int(marker['step']), int(marker['chan'])),
+                                    str(marker['eye']))
+    else:
+        for step, step_markers in markers.items():
+            for marker in step_markers:
+                channel_eyes.setdefault((step, marker['chan']), marker['eye'])
+    result_eyes = {}
+    if isinstance(summary, np.ndarray):
+        for row in summary:
+            result_eyes.setdefault((int(row['step']), int(row['result'])), str(row['eye']))
+    else:
+        for step, rows in summary.items():
+            for row in rows:
+                result_eyes.setdefault((step, row['result']), row['eye'])
+    return channel_eyes, result_eyes
+
+
+def _matches(column, value):
+    """
+    Mask of column equal to value, or to any of value if it is a list,
+    tuple or set
+    """
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return np.isin(column, list(value))
+    return column == value
+
+
+class WaveformStore():
+    """
+    Append only store of waveforms from many exports, see the module
+    docstring.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.values_path = os.path.join(directory, 'values.f64')
+        self.index_path = os.path.join(directory, 'index.bin')
+        self.files_path = os.path.join(directory, 'files.jsonl')
+        for path in (self.values_path, self.index_path, self.files_path):
+            if not os.path.exists(path):
+                open(path, 'ab').close()
+        self._index = None
+        self._values = None
+        self._files = self._read_files()
+        self._drop_orphans()
+
+    def __len__(self):
+        return len(self.index)
+
+    def _read_files(self):
+        files = []
+        with open(self.files_path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    files.append(json.loads(line))
+        return files
+
+    def _drop_orphans(self):
+        """
+        Records are written before their file entry, so an interrupted add
+        can leave records at the end of the index whose file was never
+        recorded. They are removed so the file id is not reused for them.
+        """
+        orphans = np.flatnonzero(self.index['file'] >= len(self._files))
+        if len(orphans):
+            logger.warning('Removing {} records of an interrupted add'.format(
+                len(self.index) - orphans[0]))
+            self._index = None
+            with open(self.index_path, 'r+b') as f:
+                f.truncate(int(orphans[0]) * INDEX_DTYPE.itemsize)
+
+    @property
+    def index(self):
+        """
+        Structured array of every record in the store, memory mapped
+        """
+        count = os.path.getsize(self.index_path) // INDEX_DTYPE.itemsize
+        if self._index is None or len(self._index) != count:
+            if count:
+                self._index = np.memmap(self.index_path, dtype=INDEX_DTYPE,
+                                        mode='r', shape=(count,))
+            else:
+                self._index = np.empty(0, dtype=INDEX_DTYPE)
+        return self._index
+
+    @property
+    def values(self):
+        """
+        Every stored value, memory mapped
+        """
+        count = os.path.getsize(self.values_path) // 8
+        if self._values is None or len(self._values) != count:
+            if count:
+                self._values = np.memmap(self.values_path, dtype=np.float64,
+                                         mode='r', shape=(count,))
+            else:
+                self._values = np.empty(0)
+        return self._values
+
+    def _superseded(self):
+        """
+        Boolean array, True for file entries whose source was added again
+        later. Entries without a source are never superseded.
+        """
+        superseded = np.zeros(len(self._files), dtype=bool)
+        latest = {}
+        for file_id, entry in enumerate(self._files):
+            source = entry['source']
+            if source:
+                if source in latest:
+                    superseded[latest[source]] = True
+                latest[source] = file_id
+        return superseded
+
+    def _latest(self, source):
+        for entry in reversed(self._files):
+            if entry['source'] == source:
+                return entry
+        return None
+
+    @property
+    def files(self):
+        """
+        Structured array of the file table, row i is file id i, with a
+        superseded field set for entries whose source was added again
+        """
+        columns = {name: [entry[name] for entry in self._files] for name in FILE_FIELDS}
+        dtype = [(name, 'U{}'.format(max([len(value) for value in columns[name]] + [1])))
+                 for name in FILE_FIELDS if name != 'date']
+        dtype.insert(FILE_FIELDS.index('date'), ('date', 'datetime64[s]'))
+        dtype.append(('superseded', '?'))
+        files = np.empty(len(self._files), dtype=dtype)
+        for name in FILE_FIELDS:
+            if name == 'date':
+                files[name] = [_date(value) for value in columns[name]]
+            else:
+                files[name] = columns[name]
+        files['superseded'] = self._superseded()
+        return files
+
+    def sources(self):
+        """
+        The set of source names already in the store
+        """
+        return set(entry['source'] for entry in self._files)
+
+    def _append(self, file_entry, records, series):
+        """
+        Write the values of series, then their records, then the file
+        entry, so a file is only recorded once all its waveforms are
+        """
+        file_id = len(self._files)
+        index = np.zeros(len(records), dtype=INDEX_DTYPE)
+        offset = os.path.getsize(self.values_path) // 8
+        with open(self.values_path, 'ab') as f:
+            for record, ts in zip(records, series):
+                values = np.ascontiguousarray(ts.values, dtype=np.float64)
+                record['start'] = ts.start
+                record['delta'] = ts.delta
+                record['offset'] = offset
+                record['length'] = len(values)
+                offset += len(values)
+                f.write(values.tobytes())
+        for idx, record in enumerate(records):
+            index['file'][idx] = file_id
+            for name, value in record.items():
+                index[name][idx] = value
+        with open(self.index_path, 'ab') as f:
+            f.write(index.tobytes())
+        file_entry = {name: file_entry[name] for name in FILE_FIELDS + FILE_STATE_FIELDS
+                      if name in file_entry}
+        with open(self.files_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(file_entry) + '\n')
+        self._files.append(file_entry)
+        return len(records)
+
+    def add(self, info, data, source='', include_trials=True):
+        """
+        Add the waveforms of a parsed export.
+        info, data - as returned by load_file
+        source - name recorded with the export, e.g. the file path. Any
+                 earlier export with the same source is superseded.
+        include_trials - also store the individual trials of VEP/ERG results
+        Returns the number of waveforms added.
+        """
+        return self._add(info, data, source, include_trials, {})
+
+    def _add(self, info, data, source, include_trials, file_state):
+        if info['type'] == 'mferg':
+            params = data['params']
+            date = _date(params.get('Test Date'))
+            file_entry = {'hosp': str(params.get('Hosp#', '')),
+                          'date': '' if np.isnat(date) else str(date),
+                          'test_type': info['test_type'],
+                          'protocol': str(params.get('Protocol', '')),
+                          'source': source}
+            file_entry.update(file_state)
+            common = {'step': MISSING, 'channel': MISSING, 'result': MISSING,
+                      'trial': 0}
+            records = []
+            series = []
+            for eye, kinds in data['data'].items():
+                for kind, hexagons in kinds.items():
+                    for hex_id, ts in hexagons.items():
+                        records.append(dict(common, eye=eye.upper(), kind=kind,
+                                            hexagon=int(hex_id)))
+                        series.append(ts)
+            return self._append(file_entry, records, series)
+
+        headers = data['headers']
+        date = _date(headers.get('Date performed'))
+        file_entry = {'hosp': str(headers.get('Hosp#', '')),
+                      'date': '' if np.isnat(date) else str(date),
+                      'test_type': info['test_type'],
+                      'protocol': str(headers.get('Protocol', '')),
+                      'source': source}
+        file_entry.update(file_state)
+        channel_eyes, result_eyes = _channel_eyes(data['markers'], data['summary'])
+        records = []
+        series = []
+        for step_id, step in data['data'].items():
+            for channel_id, channel in step.channels.items():
+                for result_id, result in channel.results.items():
+                    eye = channel_eyes.get((step_id, channel_id),
+                                           result_eyes.get((step_id, result_id), ''))
+                    record = dict(step=step_id, channel=channel_id, eye=eye,
+                                  result=result_id, hexagon=MISSING)
+                    if result.data is not None:
+                        records.append(dict(record, trial=0, kind='data'))
+                        series.append(result.data)
+                    if include_trials:
+                        for trial_no, trial in enumerate(result.trials, 1):
+                            records.append(dict(record, trial=trial_no, kind='trial'))
+                            series.append(trial)
+        return self._append(file_entry, records, series)
+
+    def add_file(self, fpath, include_trials=True, force=False):
+        """
+        Parse an export file with load_file and add its waveforms.
+        A file already in the store is skipped unless its size and
+        modification time, or failing those its content hash, have changed
+        since it was added, or force is True. Adding it again supersedes
+        its earlier waveforms.
+        Returns the number of waveforms added.
+        """
+        source = os.path.abspath(fpath)
+        stat = os.stat(fpath)
+        file_state = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        previous = self._latest(source)
+        if not force and previous is not None:
+            if (previous.get('size') == stat.st_size
+                    and previous.get('mtime_ns') == stat.st_mtime_ns):
+                logger.debug('Already stored:{}'.format(fpath))
+                return 0
+            file_state['sha256'] = file_hash(fpath)
+            if previous.get('sha256') == file_state['sha256']:
+                logger.debug('Already stored, unchanged:{}'.format(fpath))
+                return 0
+        if 'sha256' not in file_state:
+            file_state['sha256'] = file_hash(fpath)
+        info, data = parse_espion_export.load_file(fpath, include_trials=include_trials)
+        return self._add(info, data, source, include_trials, file_state)
+
+    def select(self, kind='data', date_from=None, date_to=None,
+               include_superseded=False, **fields):
+        """
+        Returns a boolean mask of the index records matching every filter.
+        kind - 'data', 'trial', 'raw' or 'smooth', None for any
+        include_superseded - also match records of superseded files
+        date_from, date_to - inclusive date range, datetime or 'YYYY-MM-DD'
+        fields - any other INDEX_DTYPE or FILE_FIELDS field, e.g. step=4,
+                 eye='OD' or hosp=['123', '456']
+        """
+        index = self.index
+        mask = np.ones(len(index), dtype=bool)
+        if kind is not None:
+            mask &= _matches(index['kind'], kind)
+        files = self.files
+        file_mask = np.ones(len(files), dtype=bool)
+        if not include_superseded:
+            file_mask &= ~files['superseded']
+        if date_from is not None:
+            file_mask &= files['date'] >= _date(date_from)
+        if date_to is not None:
+            if isinstance(date_to, str) and len(date_to) == 10:
+                # a bare date includes the whole day
+                date_to = np.datetime64(date_to, 'D') + np.timedelta64(1, 'D')
+                file_mask &= files['date'] < date_to
+            else:
+                file_mask &= files['date'] <= _date(date_to)
+        for name, value in fields.items():
+            if name in FILE_FIELDS:
+                file_mask &= _matches(files[name], value)
+            elif name in INDEX_DTYPE.names:
+                mask &= _matches(index[name], value)
+            else:
+                raise ValueError('Unknown field:{}'.format(name))
+        if not file_mask.all():
+            mask &= np.isin(index['file'], np.flatnonzero(file_mask))
+        return mask
+
+    def waveforms(self, records):
+        """
+        Returns the values of records stacked into a 2-D array, one row per
+        record, padded with NaN to the longest
+        """
+        lengths = records['length']
+        width = int(lengths.max()) if len(records) else 0
+        stacked = np.full((len(records), width), np.nan)
+        values = self.values
+        for row, (offset, length) in enumerate(zip(records['offset'], lengths)):
+            stacked[row, :length] = values[offset:offset + length]
+        return stacked
+
+    def query(self, kind='data', date_from=None, date_to=None,
+              include_superseded=False, **fields):
+        """
+        Returns (records, values) for the waveforms matching the filters,
+        see select for the filters and waveforms for values.
+        records are the matching index records joined with their file
+        fields, including the start and delta of each waveform.
+        """
+        mask = self.select(kind=kind, date_from=date_from, date_to=date_to,
+                           include_superseded=include_superseded, **fields)
+        index = self.index[mask]
+        files = self.files
+        records = np.empty(len(index), dtype=files.dtype.descr + INDEX_DTYPE.descr)
+        for name in INDEX_DTYPE.names:
+            records[name] = index[name]
+        if len(index):
+            for name in files.dtype.names:
+                records[name] = files[name][index['file']]
+        return records, self.waveforms(records)
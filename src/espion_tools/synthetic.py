@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+"""
+Write synthetic espion export files.
+
+The files follow the layout the parsers expect, with random waveforms,
+and are intended for benchmarking and for exercising the parsers without
+patient data.
+"""
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+VERSIONS = ('6.0.56', '6.64.14')
+
+
+class _Grid():
+    """
+    A spreadsheet like grid of cells, rows and columns numbered from 1
+    """
+    def __init__(self):
+        self.rows = {}
+
+    def put(self, row, col, values):
+        cells = self.rows.setdefault(row, {})
+        for i, value in enumerate(values):
+            cells[col + i] = str(value)
+
+    def write(self, fpath, sep, newline):
+        nrows = max(self.rows)
+        ncols = max(max(cells) for cells in self.rows.values())
+        with open(fpath, 'w', encoding='utf-8', newline='') as f:
+            for row in range(1, nrows + 1):
+                cells = self.rows.get(row, {})
+                f.write(sep.join(cells.get(col, '') for col in range(1, ncols + 1)))
+                f.write(newline)
+
+
+def _waveform(rng, samples, count, scale):
+    """
+    count noisy damped oscillations of length samples
+    """
+    t = np.arange(samples)[None, :]
+    phase = rng.uniform(0, np.pi, size=(count, 1))
+    wave = scale * np.sin(t / 5.0 + phase) * np.exp(-t / (samples * 0.6))
+    return wave + rng.normal(0, scale * 0.05, size=(count, samples))
+
+
+def write_vep_export(fpath, steps=3, channels=2, results=2, trials=3,
+                     samples=250, version='6.64.14', norms=False,
+                     test_method='ERG Test', step_descriptions=None,
+                     step_scales=None, sep='\t', newline='\r\n', seed=None):
+    """
+    Write a synthetic VEP/ERG export.
+    steps, channels, results - size of the protocol
+    trials - individual trials stored after each averaged result
+    samples - samples in the first step, each later step is 10 samples
+              longer so the data table has ragged columns
+    version - '6.64.14' or '6.0.56', selects the marker table layout
+    norms - include normal ranges in the marker table (6.0.56 layout only)
+    test_method - 'ERG Test', 'VEP Test' or 'EOG Test'
+    step_descriptions - list of descriptions for the stimulus table
+    step_scales - list of the waveform amplitude of each step, default 50
+    """
+    if version not in VERSIONS:
+        raise ValueError('version must be one of {}'.format(VERSIONS))
+    new_version = version == VERSIONS[1]
+    if norms and new_version:
+        raise ValueError('norms are only supported with the 6.0.56 layout')
+    rng = np.random.default_rng(seed)
+    grid = _Grid()
+    top = 3
+
+    header_rows = [('Test method', test_method),
+                   ('Protocol', 'Synthetic {} steps'.format(steps)),
+                   ('Date performed', '03/14/2019  10:22:01 AM'),
+                   ('Steps', steps),
+                   ('Channels', channels),
+                   ('Hosp#', '000000'),
+                   ('Name', 'Synthetic')]
+    if new_version:
+        header_rows += [('Version', version), ('Age', '44')]
+        patient = ['Normal', 'Synthetic', '000000', '44', '03/14/2019', '']
+    else:
+        header_rows += [('DOB', '01/02/1975')]
+        patient = ['Normal', 'Synthetic', '000000', '01/02/1975', '03/14/2019']
+
+    marker_rows = []
+    for step in range(1, steps + 1):
+        for chan in range(1, channels + 1):
+            for result in range(1, results + 1):
+                for name, result_str in (('a', '{}A'.format(result)),
+                                         ('b', str(result))):
+                    row = patient + [step, chan, result_str,
+                                     'OD' if chan % 2 else 'OS', name]
+                    amp = round(rng.uniform(-50, 150), 2)
+                    time = round(rng.uniform(10, 60), 1)
+                    if norms:
+                        row += [amp, '100+/-20', time, '30+/-5', '']
+                    else:
+                        row += [amp, time]
+                    marker_rows.append(row)
+    summary_rows = [[step, 'Synthetic', step, result, 'OU', trials, 0, '', '']
+                    for step in range(1, steps + 1)
+                    for result in range(1, results + 1)]
+    if step_descriptions is None:
+        step_descriptions = ['Step {}'.format(step) for step in range(1, steps + 1)]
+    if step_scales is None:
+        step_scales = [50.0] * steps
+    stimulus_rows = [[step, step_descriptions[step - 1], 'Flash']
+                     for step in range(1, steps + 1)]
+
+    # sections are laid out left to right with a blank column between them
+    sections = []
+    col = 7
+    for name, rows in (('Header Table', header_rows),
+                       ('Marker Table', marker_rows),
+                       ('Summary Table', summary_rows),
+                       ('Stimulus Table', stimulus_rows)):
+        width = len(rows[0])
+        grid.put(1, col, [name])
+        for i, row in enumerate(rows):
+            grid.put(top + i, col, row)
+        sections.append((name, col, top, col + width - 1, top + len(rows) - 1))
+        col += width + 1
+
+    # data table, a step summary followed by the time column of each step
+    # and the average and trials of every result
+    data_left = col
+    lengths = {step: samples + 10 * (step - 1) for step in range(1, steps + 1)}
+    grid.put(1, data_left, ['Data Table'])
+    grid.put(top - 1, data_left, ['Step', 'Column', 'Chan', 'Result', 'Column', 'Trials'])
+    col = data_left + 7
+    summary_row = top
+    for step in range(1, steps + 1):
+        length = lengths[step]
+        step_col = col
+        grid.put(top - 1, step_col, ['ms'])
+        for i, value in enumerate(-20 + np.arange(length) * 0.5):
+            grid.put(top + i, step_col, ['{:.1f}'.format(value)])
+        col += 1
+        for chan in range(1, channels + 1):
+            for result in range(1, results + 1):
+                grid.put(summary_row, data_left,
+                         [step, step_col, chan, result, col, trials])
+                summary_row += 1
+                scale = step_scales[step - 1]
+                waves = _waveform(rng, length, trials, scale=scale)
+                if trials:
+                    average = waves.mean(axis=0)
+                else:
+                    average = _waveform(rng, length, 1, scale=scale)[0]
+                grid.put(top - 1, col, ['uV'] + ['Trial (nV)'] * trials)
+                block = np.vstack([average[None, :], waves * 1000])
+                for i, row in enumerate(block.T):
+                    grid.put(top + i, col, ['{:.3f}'.format(value) for value in row])
+                col += 1 + trials
+    sections.append(('Data Table', data_left, top, col - 1,
+                     top + max(lengths.values()) - 1))
+
+    grid.put(1, 1, ['Contents Table'])
+    grid.put(2, 1, ['Table', 'Col', 'Row', 'Col', 'Row'])
+    grid.put(3, 1, ['', 'Left', 'Top', 'Right', 'Bottom'])
+    for i, section in enumerate(sections):
+        grid.put(4 + i, 1, section)
+    # a blank row after the contents table ends it
+    grid.put(4 + len(sections), 1, [''])
+    grid.write(fpath, sep, newline)
+
+
+def write_eog_export(fpath, dark_steps=8, light_steps=12, trough=200.0,
+                     peak=400.0, **options):
+    """
+    Write a synthetic EOG export, steps 'Dark 1'.. then 'Light 1'..
+    The saccade amplitude falls to trough at the middle of the dark phase
+    and rises to peak at the middle of the light phase, so the Arden ratio
+    is close to peak / trough.
+    options - passed to write_vep_export
+    """
+    dark = trough + (trough * 1.5 - trough) * np.cos(np.linspace(0, np.pi, dark_steps)) ** 2
+    light = trough + (peak - trough) * np.sin(np.linspace(0, np.pi, light_steps))
+    descriptions = (['Dark {}'.format(i) for i in range(1, dark_steps + 1)]
+                    + ['Light {}'.format(i) for i in range(1, light_steps + 1)])
+    options.setdefault('trials', 0)
+    write_vep_export(fpath, steps=dark_steps + light_steps, test_method='EOG Test',
+                     step_descriptions=descriptions,
+                     step_scales=list(dark) + list(light), **options)
+
+
+def write_mferg_export(fpath, hexagons=61, binocular=True, eye='od',
+                       samples=120, sep='\t', newline='\r\n', seed=None):
+    """
+    Write a synthetic mfERG export.
+    hexagons - 61 or 103 are the usual stimulus sizes
+    binocular - export both eyes, otherwise only eye ('od' or 'os')
+    samples - samples in each time series
+    """
+    rng = np.random.default_rng(seed)
+    grid = _Grid()
+    parameters = [('Hexagons', hexagons), ('Scaled', 'Yes'), ('Distortion', '0'),
+                  ('Filter', 'On'), ('Base Period', '13.33 ms'),
+                  ('Correlated', '1 frames'), ('Sequence Bits', 14),
+                  ('Smoothing', 'Average [17%]'), ('Filtering', 'Off'),
+                  ('Filler Frames', 0), ('Background', 'Black'),
+                  ('Color On', 'White'), ('Luminance On', '200cd/m2'),
+                  ('Color Off', 'Black'), ('Luminance Off', '0cd/m2'),
+                  ('Mains Rejection', 'On'), ('Noise Rejection', '1 pass'),
+                  ('Test Date', '11/22/2017'), ('DOB', '05/06/1980'),
+                  ('Kernel Order', 1)]
+    eyes = ['od', 'os'] if binocular else [eye]
+    eye_names = {'od': 'Right Eye', 'os': 'Left Eye'}
+
+    grid.put(1, 1, ['Parameter', 'Value'])
+    for i, parameter in enumerate(parameters):
+        grid.put(2 + i, 1, parameter)
+
+    # markers, N1 and P1 amplitude and time for each eye
+    col = 4
+    grid.put(1, col, ['Hexagon'])
+    grid.put(2, col, ['Hexagon'])
+    for i, e in enumerate(eyes):
+        grid.put(1, col + 1 + 4 * i, [eye_names[e]])
+        grid.put(2, col + 1 + 4 * i, ['N1 Amp', 'N1 Time', 'P1 Amp', 'P1 Time'])
+    for hex_id in range(1, hexagons + 1):
+        row = [hex_id]
+        for e in eyes:
+            row += [round(rng.uniform(-100, 0), 2), round(rng.uniform(10, 20), 1),
+                    round(rng.uniform(0, 200), 2), round(rng.uniform(25, 35), 1)]
+        grid.put(2 + hex_id, col, row)
+    col += 2 + 4 * len(eyes)
+
+    grid.put(1, col, ['Dimensions'])
+    for i, dimension in enumerate((('Width', 40), ('Height', 30), ('Distance', 25))):
+        grid.put(2 + i, col, dimension)
+    col += 3
+
+    # seven vertices per hexagon
+    grid.put(1, col, ['Hexagon', 'X', 'Y'])
+    angles = np.arange(7) * np.pi / 3
+    for hex_id in range(1, hexagons + 1):
+        for k, angle in enumerate(angles):
+            grid.put(2 + (hex_id - 1) * 7 + k, col,
+                     [hex_id if k == 0 else '',
+                      round(hex_id + np.cos(angle), 3),
+                      round(hex_id + np.sin(angle), 3)])
+    col += 4
+
+    grid.put(2, col, ['Time (ms)'])
+    for i in range(samples):
+        grid.put(3 + i, col, ['{:.3f}'.format(i * 0.833)])
+    col += 1
+    for e in eyes:
+        grid.put(1, col, ['{} (nV)'.format(eye_names[e])])
+        raw = _waveform(rng, samples, hexagons, scale=100.0)
+        smooth = raw * 0.9
+        for hex_id in range(1, hexagons + 1):
+            grid.put(2, col, ['Hex {} (R)'.format(hex_id), 'Hex {} (S)'.format(hex_id)])
+            for i in range(samples):
+                grid.put(3 + i, col, ['{:.2f}'.format(raw[hex_id - 1, i]),
+                                      '{:.2f}'.format(smooth[hex_id - 1, i])])
+            col += 2
+    # the time series end at the first row with an empty time cell
+    grid.put(3 + samples, 1, [''])
+    # trailing empty column so no label is followed by the line ending
+    grid.put(2, col, [''])
+    grid.write(fpath, sep, newline)
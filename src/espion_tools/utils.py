@@ -1,10 +1,17 @@
 from datetime import datetime
+from operator import itemgetter
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
 
 def as_int(val):
 	"""
 	Tries to convert a string to an int.
 	Returns None if string is empty
 	"""
+	if val == '':
+		return(None)
 	try:
 		return(int(val))
 	except ValueError:
@@ -15,11 +22,96 @@ def as_float(val):
 	Tries to convert a string to an float.
 	Returns None if string is empty
 	"""
+	if val == '':
+		return(None)
 	try:
 		return(float(val))
 	except ValueError:
 		return(None)
 
+def as_float_array(values, with_mask=False):
+    """
+    Converts a sequence of strings to a float array in one go.
+    Strings that are not numbers (including empty strings) are NaN.
+    If with_mask is True returns (array, valid) where valid is False
+    for the cells that were NaN.
+    """
+    try:
+        floats = np.array([val if val else 'nan' for val in values], dtype=float)
+    except ValueError:
+        floats = np.array([as_float(val) for val in values], dtype=float)
+    if with_mask:
+        return floats, ~np.isnan(floats)
+    return floats
+
+def as_float_block(rows, width=None, with_mask=False):
+    """
+    Converts rows of strings, e.g. split lines, to a 2-D float array in
+    one call. Rows shorter than width (default the longest row) are
+    padded with NaN and empty cells are NaN.
+    Raises ValueError if a cell is neither empty nor a number, so a
+    corrupt table is not read as misaligned data.
+    If with_mask is True returns (array, valid) as for as_float_array.
+    """
+    rows = list(rows)
+    if width is None:
+        width = max((len(row) for row in rows), default=0)
+    cells = []
+    for row in rows:
+        cells.extend(row[:width])
+        if len(row) < width:
+            cells.extend([''] * (width - len(row)))
+    cells = [cell if cell.strip() else 'nan' for cell in cells]
+    try:
+        floats = np.array(cells, dtype=float).reshape(len(rows), width)
+    except ValueError:
+        for idx, cell in enumerate(cells):
+            try:
+                float(cell)
+            except ValueError:
+                raise ValueError('Not a number:{!r} in row {}, column {} of the block'
+                                 .format(cell, idx // width, idx % width)) from None
+        raise
+    if with_mask:
+        return floats, ~np.isnan(floats)
+    return floats
+
+def stack_tables(tables, ids=None, id_name='file'):
+    """
+    Joins structured arrays, e.g. the marker tables of many files, into one.
+    ids - optional label for each table, added to every record of that
+          table in a field called id_name so the rows can be traced back
+    """
+    tables = list(tables)
+    if not tables:
+        raise ValueError('No tables to stack')
+    table = np.concatenate(tables)
+    if ids is None:
+        return table
+    ids = list(ids)
+    if len(ids) != len(tables):
+        raise ValueError('Expected {} ids, got {}'.format(len(tables), len(ids)))
+    labels = np.repeat(np.array(ids, dtype=object), [len(t) for t in tables])
+    dtype = np.dtype([(id_name, 'O')] + table.dtype.descr)
+    stacked = np.empty(len(table), dtype=dtype)
+    stacked[id_name] = labels
+    for name in table.dtype.names:
+        stacked[name] = table[name]
+    return stacked
+
+def move_top(f, lines):
+    """
+    Takes an open file and moves to the start of lines.
+    An ExportFile jumps straight there using its row index, any other
+    file object is rewound and read forward.
+    """
+    if hasattr(f, 'seek_row'):
+        f.seek_row(lines)
+        return
+    f.seek(0)
+    for i in range(lines - 1):
+        f.readline()
+
 def read_split_line(f, split='\t', start_col=None):
     line = f.readline()
     line = line.split(split)
@@ -27,6 +119,49 @@ def read_split_line(f, split='\t', start_col=None):
         line = line[start_col:]
     return line
 
+def read_float_columns(f, first_row, columns, split='\t', end_col=None,
+                       workers=None):
+    """
+    Reads the given columns (0 based) from first_row to the end of the file,
+    or the first empty row.
+    If end_col is given reading also stops at the first row with an empty
+    cell in that column.
+    Returns a 2-D float array with one row per requested column so each
+    column of the file is contiguous in memory. Empty or non numeric
+    cells are NaN.
+    An ExportFile tokenizes the columns straight from its bytes, falling
+    back to splitting each line if that fails.
+    workers are passed to ExportFile.read_float_block to tokenize a large
+    block in parallel.
+    """
+    if hasattr(f, 'read_float_block'):
+        try:
+            return f.read_float_block(first_row, columns, split, end_col=end_col,
+                                      workers=workers)
+        except ValueError as e:
+            logger.debug('Falling back to line by line parsing ({})'.format(e))
+    move_top(f, first_row)
+    width = max(columns + [end_col or 0]) + 1
+    if len(columns) == 1:
+        getter = lambda values: (values[columns[0]],)
+    else:
+        getter = itemgetter(*columns)
+    rows = []
+    while True:
+        line = f.readline().rstrip('\r\n')
+        if line == '':
+            break
+        values = line.split(split)
+        if len(values) < width:
+            values.extend([''] * (width - len(values)))
+        if end_col is not None and values[end_col] == '':
+            break
+        rows.append(getter(values))
+    block = as_float_block(rows, len(columns))
+    if hasattr(f, 'floats_read'):
+        f.floats_read += block.size
+    return np.ascontiguousarray(block.T)
+
 def find_section_col(values, strings, start = 0):
     """
     returns the index in values that matches strings or None
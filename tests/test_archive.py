@@ -0,0 +1,88 @@
+"""
+Round trips of parsed exports through the .npz archive
+"""
+import numpy as np
+import pytest
+
+from espion_tools.archive import load_npz, save_npz
+from espion_tools.espion_objects import TimeSeries
+from espion_tools.parse_espion_export import load_file
+from espion_tools.synthetic import (write_eog_export, write_mferg_export,
+                                    write_vep_export)
+
+
+def assert_same(a, b, path='data'):
+    """
+    Recursive equality that also compares numpy arrays, including
+    structured tables
+    """
+    assert type(a) is type(b) or (isinstance(a, np.ndarray) and isinstance(b, np.ndarray)), path
+    if isinstance(a, dict):
+        assert list(a) == list(b), path
+        for key in a:
+            assert_same(a[key], b[key], '{}[{!r}]'.format(path, key))
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b), path
+        for idx, (x, y) in enumerate(zip(a, b)):
+            assert_same(x, y, '{}[{}]'.format(path, idx))
+    elif isinstance(a, np.ndarray):
+        assert a.dtype == b.dtype and a.shape == b.shape, path
+        if a.dtype.names:
+            for name in a.dtype.names:
+                assert_same(a[name], b[name], '{}.{}'.format(path, name))
+        elif a.dtype.kind == 'f':
+            np.testing.assert_array_equal(a, b, err_msg=path)
+        else:
+            assert a.tolist() == b.tolist(), path
+    elif isinstance(a, float) and np.isnan(a):
+        assert np.isnan(b), path
+    else:
+        assert a == b, path
+
+
+def _export(tmp_path, kind):
+    fpath = str(tmp_path / 'export.txt')
+    if kind == 'vep':
+        write_vep_export(fpath, seed=1)
+    elif kind == 'vep_old':
+        write_vep_export(fpath, version='6.0.56', norms=True, seed=2)
+    elif kind == 'eog':
+        write_eog_export(fpath, dark_steps=4, light_steps=6, seed=3)
+    else:
+        write_mferg_export(fpath, hexagons=19, seed=4)
+    return fpath
+
+
+@pytest.mark.parametrize('mmap', [False, True], ids=['read', 'mmap'])
+@pytest.mark.parametrize('tables', [False, True], ids=['dicts', 'tables'])
+@pytest.mark.parametrize('kind', ['vep', 'vep_old', 'eog', 'mferg'])
+def test_round_trip(tmp_path, kind, tables, mmap):
+    if tables and kind == 'mferg':
+        pytest.skip('tables only apply to VEP/ERG exports')
+    info, data = load_file(_export(tmp_path, kind), tables=tables)
+    archive = str(tmp_path / 'export.npz')
+    save_npz(archive, data, info)
+
+    loaded_info, loaded = load_npz(archive, mmap=mmap)
+    assert loaded_info == info
+    assert_same(data, loaded)
+
+
+def test_mmap_series_are_views(tmp_path):
+    info, data = load_file(_export(tmp_path, 'vep'))
+    archive = str(tmp_path / 'export.npz')
+    save_npz(archive, data, info)
+
+    _, loaded = load_npz(archive, mmap=True)
+    result = loaded['data'][1].channels[1].results[1]
+    assert isinstance(result.data, TimeSeries)
+    assert isinstance(result.data.values.base, np.memmap)
+    # trials keep their 2-D shape
+    assert result.trials.values.shape == data['data'][1].channels[1].results[1].trials.values.shape
+
+
+def test_without_trials(tmp_path):
+    info, data = load_file(_export(tmp_path, 'vep'), include_trials=False)
+    archive = str(tmp_path / 'export.npz')
+    save_npz(archive, data, info)
+    assert_same(data, load_npz(archive)[1])
@@ -0,0 +1,115 @@
+"""
+The byte level tokenizer of ExportFile against the line by line path
+"""
+import numpy as np
+import pytest
+
+from espion_tools import export_file
+from espion_tools.export_file import ExportFile, _fill_empty, _tokenize
+from espion_tools.parse_espion_export import load_file
+from espion_tools.parse_vep_export import read_contents_and_header
+from espion_tools.synthetic import write_mferg_export, write_vep_export
+from espion_tools.utils import read_float_columns
+
+SEPARATORS = {'tab': '\t', 'comma': ','}
+NEWLINES = {'crlf': '\r\n', 'lf': '\n'}
+
+
+def _trim_trailing(fpath, sep, first_row):
+    """
+    Drop the empty trailing cells of every row, as some exports do, and
+    the last two cells of every other row from first_row so the data
+    table is ragged
+    """
+    with open(fpath, encoding='utf-8', newline='') as f:
+        lines = f.read().splitlines(keepends=True)
+    with open(fpath, 'w', encoding='utf-8', newline='') as f:
+        for row, line in enumerate(lines, 1):
+            body = line.rstrip('\r\n')
+            ending = line[len(body):]
+            if row >= first_row and row % 2:
+                body = sep.join(body.split(sep)[:-2])
+            f.write(body.rstrip(sep) + ending)
+
+
+def _data_table_columns(fpath, sep):
+    with ExportFile(fpath) as f:
+        contents, _ = read_contents_and_header(f, sep)
+    table = contents['Data Table']
+    return table['top'], list(range(table['left'] - 1, table['right']))
+
+
+@pytest.mark.parametrize('block, expected', [
+    (b'1\t2\n', b'1\t2\n'),
+    (b'\t2\n', b'nan\t2\n'),
+    (b'1\t\t3\n', b'1\tnan\t3\n'),
+    (b'1\t\n', b'1\tnan\n'),
+    (b'1\t\r\n\t2\r\n', b'1\tnan\r\nnan\t2\r\n'),
+    (b'1\t', b'1\tnan'),
+    (b'\t\t\n', b'nan\tnan\tnan\n'),
+])
+def test_fill_empty(block, expected):
+    assert _fill_empty(block, b'\t') == expected
+
+
+def test_tokenize_empty_fields_are_nan():
+    values = _tokenize(b'1,,3\r\n,5,\r\n', ',', [0, 1, 2])
+    np.testing.assert_array_equal(values, [[1, np.nan, 3], [np.nan, 5, np.nan]])
+
+
+def test_tokenize_short_rows_raise():
+    with pytest.raises(ValueError):
+        _tokenize(b'1\t2\t3\n4\n', '\t', [0, 1, 2])
+
+
+@pytest.mark.parametrize('newline', NEWLINES.values(), ids=NEWLINES.keys())
+@pytest.mark.parametrize('sep', SEPARATORS.values(), ids=SEPARATORS.keys())
+@pytest.mark.parametrize('trim', [False, True], ids=['full', 'ragged'])
+def test_data_table_matches_line_path(tmp_path, sep, newline, trim):
+    fpath = str(tmp_path / 'export.txt')
+    write_vep_export(fpath, sep=sep, newline=newline, seed=1)
+    top, columns = _data_table_columns(fpath, sep)
+    if trim:
+        _trim_trailing(fpath, sep, top + 50)
+
+    with ExportFile(fpath) as f:
+        from_bytes = read_float_columns(f, top, columns, sep)
+    with open(fpath, encoding='utf-8') as f:
+        from_lines = read_float_columns(f, top, columns, sep)
+
+    assert from_bytes.shape == from_lines.shape
+    np.testing.assert_array_equal(from_bytes, from_lines)
+    # steps have different lengths, so the table has empty cells
+    assert np.isnan(from_bytes).any()
+
+
+def test_ragged_rows_fall_back(tmp_path):
+    fpath = str(tmp_path / 'export.txt')
+    write_vep_export(fpath, seed=2)
+    top, columns = _data_table_columns(fpath, '\t')
+    _trim_trailing(fpath, '\t', top + 50)
+    with ExportFile(fpath) as f:
+        with pytest.raises(ValueError):
+            f.read_float_block(top, columns, '\t')
+        blocks = [values for row, values in f.iter_float_blocks(top, columns, '\t', 7)]
+    with open(fpath, encoding='utf-8') as f:
+        from_lines = read_float_columns(f, top, columns, '\t')
+    np.testing.assert_array_equal(np.hstack(blocks), from_lines)
+
+
+@pytest.mark.parametrize('newline', NEWLINES.values(), ids=NEWLINES.keys())
+@pytest.mark.parametrize('sep', SEPARATORS.values(), ids=SEPARATORS.keys())
+@pytest.mark.parametrize('kind', ['vep', 'mferg'])
+def test_load_file_matches_line_path(tmp_path, monkeypatch, sep, newline, kind):
+    fpath = str(tmp_path / 'export.txt')
+    if kind == 'vep':
+        write_vep_export(fpath, sep=sep, newline=newline, seed=3)
+    else:
+        write_mferg_export(fpath, hexagons=19, sep=sep, newline=newline, seed=3)
+    expected = load_file(fpath)
+
+    def fail(block, sep, usecols):
+        raise ValueError('forced line by line parsing')
+
+    monkeypatch.setattr(export_file, '_tokenize', fail)
+    assert load_file(fpath) == expected
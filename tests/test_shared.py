@@ -0,0 +1,99 @@
+"""
+Handing parsed exports between processes, through shared memory and
+pickle protocol 5
+"""
+import os
+import pickle
+
+import numpy as np
+import pytest
+
+from espion_tools.espion_objects import TimeSeries
+from espion_tools.parse_espion_export import load_file, load_files
+from espion_tools.shared import share
+from espion_tools.synthetic import write_mferg_export, write_vep_export
+
+SHM_DIR = '/dev/shm'
+
+
+def _blocks():
+    if not os.path.isdir(SHM_DIR):
+        return set()
+    return set(os.listdir(SHM_DIR))
+
+
+@pytest.fixture
+def exports(tmp_path):
+    fpaths = []
+    for idx in range(3):
+        fpath = str(tmp_path / 'vep{}.txt'.format(idx))
+        write_vep_export(fpath, steps=2, seed=idx)
+        fpaths.append(fpath)
+    fpath = str(tmp_path / 'mferg.txt')
+    write_mferg_export(fpath, hexagons=19, seed=5)
+    fpaths.append(fpath)
+    return fpaths
+
+
+@pytest.fixture
+def no_leaks():
+    before = _blocks()
+    yield
+    assert _blocks() - before == set()
+
+
+def test_load_copy(exports, no_leaks):
+    for fpath in exports:
+        expected = load_file(fpath)
+        shared = share(expected)
+        assert shared.nbytes
+        assert shared.load() == expected
+
+
+def test_load_views(exports, no_leaks):
+    expected = load_file(exports[0])
+    shared = share(expected)
+    data = shared.load(copy=False)
+    assert data == expected
+    del data
+    shared.close()
+
+
+def test_pickled(exports, no_leaks):
+    expected = load_file(exports[-1])
+    shared = pickle.loads(pickle.dumps(share(expected)))
+    assert shared.load() == expected
+
+
+def test_unlink(exports, no_leaks):
+    shared = share(load_file(exports[0]))
+    shared.unlink()
+    shared.unlink()
+
+
+def test_without_values(no_leaks):
+    shared = share({'empty': TimeSeries(0.0, 1.0, np.empty(0))})
+    assert shared.name is None
+    data = shared.load()
+    assert len(data['empty']) == 0
+
+
+@pytest.mark.parametrize('shared', [False, True], ids=['pickled', 'shared'])
+def test_load_files(exports, no_leaks, shared):
+    expected = [load_file(fpath) for fpath in exports]
+    results = list(load_files(exports, workers=2, shared=shared))
+    assert [fpath for fpath, result, error in results] == exports
+    assert [error for fpath, result, error in results] == [None] * len(exports)
+    assert [result for fpath, result, error in results] == expected
+
+
+def test_pickle_protocol_5_out_of_band(exports):
+    expected = load_file(exports[0])
+    buffers = []
+    body = pickle.dumps(expected, protocol=5, buffer_callback=buffers.append)
+    # the waveforms travel as buffers rather than in the pickle
+    assert buffers
+    assert sum(buffer.raw().nbytes for buffer in buffers) > len(body)
+    assert pickle.loads(body, buffers=buffers) == expected
+    # and in band when no buffer_callback is given
+    assert pickle.loads(pickle.dumps(expected, protocol=5)) == expected
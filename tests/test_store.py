@@ -0,0 +1,159 @@
+"""
+The on disk layout of WaveformStore, against the parsed exports it holds
+"""
+import os
+
+import numpy as np
+import pytest
+
+from espion_tools.parse_espion_export import load_file
+from espion_tools.store import INDEX_DTYPE, WaveformStore
+from espion_tools.synthetic import write_mferg_export, write_vep_export
+
+
+def _stored_series(data):
+    """
+    (step, channel, result, trial) -> values of every average and trial
+    of a parsed VEP/ERG export, trial 0 for the average
+    """
+    series = {}
+    for step_id, step in data['data'].items():
+        for channel_id, channel in step.channels.items():
+            for result_id, result in channel.results.items():
+                series[step_id, channel_id, result_id, 0] = result.data
+                for trial_no, trial in enumerate(result.trials, 1):
+                    series[step_id, channel_id, result_id, trial_no] = trial
+    return series
+
+
+def test_index_record_size():
+    # 8 numeric fields and two short strings, see the store docstring
+    assert INDEX_DTYPE.itemsize == 104
+
+
+def test_query_matches_parsed(tmp_path):
+    fpath = str(tmp_path / 'export.txt')
+    write_vep_export(fpath, seed=1)
+    _, data = load_file(fpath)
+    expected = _stored_series(data)
+
+    store = WaveformStore(str(tmp_path / 'store'))
+    assert store.add_file(fpath) == len(expected)
+    assert len(store) == len(expected)
+
+    # reopened from disk
+    store = WaveformStore(str(tmp_path / 'store'))
+    records, values = store.query(kind=None)
+    assert len(records) == len(expected)
+    assert (records['source'] == os.path.abspath(fpath)).all()
+    for record, row in zip(records, values):
+        key = (record['step'], record['channel'], record['result'], record['trial'])
+        ts = expected[key]
+        assert record['kind'] == ('trial' if key[-1] else 'data')
+        assert (record['start'], record['delta']) == (ts.start, ts.delta)
+        np.testing.assert_array_equal(row[:record['length']], ts.values)
+        assert np.isnan(row[record['length']:]).all()
+
+    records, _ = store.query(step=2, channel=1)
+    assert set(zip(records['step'], records['channel'], records['trial'])) == {(2, 1, 0)}
+    assert len(records) == len(data['data'][2].channels[1].results)
+
+
+def test_mferg_query_matches_parsed(tmp_path):
+    fpath = str(tmp_path / 'export.txt')
+    write_mferg_export(fpath, hexagons=19, seed=2)
+    _, data = load_file(fpath)
+
+    store = WaveformStore(str(tmp_path / 'store'))
+    store.add_file(fpath)
+    for eye, kinds in data['data'].items():
+        for kind, hexagons in kinds.items():
+            records, values = store.query(kind=kind, eye=eye.upper())
+            assert sorted(records['hexagon']) == sorted(int(h) for h in hexagons)
+            for record, row in zip(records, values):
+                np.testing.assert_array_equal(row, hexagons[record['hexagon']].values)
+
+
+def test_long_source_is_recognised(tmp_path):
+    directory = tmp_path.joinpath(*['a_long_directory_name_{}'.format(idx) for idx in range(12)])
+    directory.mkdir(parents=True)
+    fpath = str(directory / 'export.txt')
+    assert len(os.path.abspath(fpath)) > 256
+    write_vep_export(fpath, steps=1, seed=3)
+
+    store = WaveformStore(str(tmp_path / 'store'))
+    added = store.add_file(fpath)
+    assert added
+    store = WaveformStore(str(tmp_path / 'store'))
+    assert store.add_file(fpath) == 0
+    assert store.sources() == {os.path.abspath(fpath)}
+    records, _ = store.query()
+    assert (records['source'] == os.path.abspath(fpath)).all()
+
+
+def test_drop_orphans(tmp_path):
+    fpath = str(tmp_path / 'export.txt')
+    write_vep_export(fpath, steps=1, seed=4)
+    store = WaveformStore(str(tmp_path / 'store'))
+    store.add_file(fpath)
+    count = len(store)
+
+    # an add interrupted after writing its records but before its file
+    # entry, preceded by a blank line in the file table
+    with open(store.files_path, 'a', encoding='utf-8') as f:
+        f.write('\n')
+    orphans = np.zeros(3, dtype=INDEX_DTYPE)
+    orphans['file'] = 99
+    with open(store.index_path, 'ab') as f:
+        f.write(orphans.tobytes())
+
+    store = WaveformStore(str(tmp_path / 'store'))
+    assert len(store) == count
+    assert os.path.getsize(store.index_path) == count * INDEX_DTYPE.itemsize
+    assert (store.index['file'] == 0).all()
+
+
+def test_changed_file_supersedes(tmp_path):
+    fpath = str(tmp_path / 'export.txt')
+    write_vep_export(fpath, steps=2, seed=5)
+    store = WaveformStore(str(tmp_path / 'store'))
+    first = store.add_file(fpath)
+
+    # same content, new modification time, is matched by hash
+    os.utime(fpath, ns=(0, 0))
+    assert store.add_file(fpath) == 0
+
+    write_vep_export(fpath, steps=3, seed=6)
+    _, data = load_file(fpath)
+    second = store.add_file(fpath)
+    assert second == len(_stored_series(data))
+    assert len(store) == first + second
+
+    store = WaveformStore(str(tmp_path / 'store'))
+    assert store.files['superseded'].tolist() == [True, False]
+    records, values = store.query(kind=None)
+    assert len(records) == second
+    assert (records['file'] == 1).all()
+    assert set(records['step']) == {1, 2, 3}
+
+    records, _ = store.query(kind=None, include_superseded=True)
+    assert len(records) == first + second
+
+
+def test_add_with_same_source_supersedes(tmp_path):
+    fpath = str(tmp_path / 'export.txt')
+    write_vep_export(fpath, steps=1, seed=7)
+    info, data = load_file(fpath)
+    store = WaveformStore(str(tmp_path / 'store'))
+    store.add(info, data, source='patient')
+    store.add(info, data)
+    store.add(info, data, source='patient')
+    assert store.files['superseded'].tolist() == [True, False, False]
+    records, _ = store.query()
+    assert sorted(set(records['file'])) == [1, 2]
+
+
+def test_unknown_field(tmp_path):
+    store = WaveformStore(str(tmp_path / 'store'))
+    with pytest.raises(ValueError):
+        store.select(colour='red')
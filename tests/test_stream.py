@@ -0,0 +1,101 @@
+"""
+stream_data_table against parse_data_table on the same exports
+"""
+import numpy as np
+import pytest
+
+from espion_tools.parse_espion_export import load_file
+from espion_tools.parse_vep_export import stream_data_table
+from espion_tools.synthetic import write_vep_export
+
+BLOCK_ROWS = [1, 2, 7, 256]
+
+
+def _blank_cells(fpath, top, column, rows, sep='\t'):
+    """
+    Empty the cells of the 1-based column at data table rows (from 0)
+    """
+    with open(fpath, encoding='utf-8', newline='') as f:
+        lines = f.read().splitlines(keepends=True)
+    for row in rows:
+        line = lines[top - 1 + row]
+        body = line.rstrip('\r\n')
+        cells = body.split(sep)
+        cells[column - 1] = ''
+        lines[top - 1 + row] = sep.join(cells) + line[len(body):]
+    with open(fpath, 'w', encoding='utf-8', newline='') as f:
+        f.writelines(lines)
+
+
+def _stream(fpath, block_rows, **options):
+    """
+    Returns {(step, channel, result, trial): [series, ..]} of the blocks
+    passed to the sink
+    """
+    blocks = {}
+
+    def sink(step, channel, result, trial, series):
+        blocks.setdefault((step, channel, result, trial), []).append(series)
+
+    stream_data_table(fpath, sink, block_rows=block_rows, **options)
+    return blocks
+
+
+def _expected(data):
+    series = {}
+    for step_id, step in data['data'].items():
+        for channel_id, channel in step.channels.items():
+            for result_id, result in channel.results.items():
+                series[step_id, channel_id, result_id, 0] = result.data
+                for trial_no, trial in enumerate(result.trials, 1):
+                    series[step_id, channel_id, result_id, trial_no] = trial
+    return series
+
+
+def _assert_blocks_match(blocks, expected):
+    assert set(blocks) == set(expected)
+    for key, ts in expected.items():
+        values = np.concatenate([series.values for series in blocks[key]])
+        np.testing.assert_array_equal(values, ts.values, err_msg=str(key))
+        position = 0
+        for series in blocks[key]:
+            assert series.delta == pytest.approx(ts.delta)
+            assert series.start == pytest.approx(ts.start + position * ts.delta)
+            position += len(series)
+
+
+@pytest.mark.parametrize('block_rows', BLOCK_ROWS)
+def test_stream_matches_parse(tmp_path, block_rows):
+    fpath = str(tmp_path / 'export.txt')
+    write_vep_export(fpath, steps=3, samples=40, seed=1)
+    _, data = load_file(fpath)
+    _assert_blocks_match(_stream(fpath, block_rows), _expected(data))
+
+
+@pytest.mark.parametrize('block_rows', BLOCK_ROWS)
+def test_stream_options(tmp_path, block_rows):
+    fpath = str(tmp_path / 'export.txt')
+    write_vep_export(fpath, steps=3, samples=40, seed=2)
+    _, data = load_file(fpath, steps=[2, 3], channels=[2], include_trials=False)
+    blocks = _stream(fpath, block_rows, steps=[2, 3], channels=[2],
+                     include_trials=False)
+    _assert_blocks_match(blocks, _expected(data))
+
+
+@pytest.mark.parametrize('block_rows', BLOCK_ROWS)
+def test_empty_cells_stay_in_place(tmp_path, block_rows):
+    fpath = str(tmp_path / 'export.txt')
+    write_vep_export(fpath, steps=2, samples=40, seed=3)
+    _, data = load_file(fpath)
+    top = data['contents']['Data Table']['top']
+    column = data['data'][1].channels[1].results[1].column
+    # a lone empty cell, one at the end of a 7 row block and a run that
+    # fills whole blocks of 1 or 2 rows
+    blanked = [3, 6, 20, 21, 22, 23]
+    _blank_cells(fpath, top, column, blanked)
+
+    _, data = load_file(fpath)
+    average = data['data'][1].channels[1].results[1].data
+    assert len(average) == 40
+    assert np.flatnonzero(np.isnan(average.values)).tolist() == blanked
+    _assert_blocks_match(_stream(fpath, block_rows), _expected(data))